@@ -25,6 +25,13 @@ class DatabaseConfig:
         # SSL settings for ODBC
         self.trust_server_certificate = os.getenv('DB_TRUST_CERTIFICATE', 'yes')
         self.encrypt = os.getenv('DB_ENCRYPT', 'yes')
+        
+        # Multiple active result sets: lets patient scans stream while
+        # per-patient lookups run on the same connection
+        self.mars_connection = os.getenv('DB_MARS_CONNECTION', 'yes')
+        
+        # Idle connections kept open between syncs (0 disables reuse)
+        self.pool_size = int(os.getenv('DB_POOL_SIZE', '4'))
     
     @property
     def connection_string(self):
@@ -37,6 +44,7 @@ class DatabaseConfig:
             f"PWD={self.password};"
             f"TrustServerCertificate={self.trust_server_certificate};"
             f"Encrypt={self.encrypt};"
+            f"MARS_Connection={self.mars_connection};"
             f"Connection Timeout={self.connection_timeout};"
             f"Command Timeout={self.command_timeout};"
         )
@@ -86,6 +94,7 @@ class SyncConfig:
     def __init__(self):
         self.interval_minutes = int(os.getenv('SYNC_INTERVAL_MINUTES', '5'))
         self.batch_size = int(os.getenv('SYNC_BATCH_SIZE', '50'))
+        self.upload_concurrency = int(os.getenv('SYNC_UPLOAD_CONCURRENCY', '2'))
         self.deep_sync_hour_morning = int(os.getenv('DEEP_SYNC_HOUR_MORNING', '8'))
         self.deep_sync_hour_evening = int(os.getenv('DEEP_SYNC_HOUR_EVENING', '20'))
 
@@ -98,6 +107,8 @@ class AppConfig:
         self.timezone = os.getenv('TIMEZONE', 'Europe/Moscow')
         self.rate_limit_requests = int(os.getenv('RATE_LIMIT_REQUESTS', '7'))
         self.rate_limit_period = int(os.getenv('RATE_LIMIT_PERIOD', '1'))
+        self.amocrm_concurrency = int(os.getenv('AMOCRM_CONCURRENCY', '8'))
+        self.amocrm_max_connections = int(os.getenv('AMOCRM_MAX_CONNECTIONS', '16'))
 
 
 # AmoCRM pipeline and field configuration
@@ -0,0 +1,20 @@
+"""Shared loguru setup for the integration test scripts."""
+
+import sys
+from loguru import logger
+
+# Console format used by every test script
+TEST_LOG_FORMAT = "<green>{time:YYYY-MM-DD HH:mm:ss}</green> | <level>{level: <8}</level> | <cyan>{name}</cyan>:<cyan>{function}</cyan>:<cyan>{line}</cyan> - <level>{message}</level>"
+
+_configured = False
+
+
+def configure_test_logging():
+    """Route test logs to stdout at DEBUG, once per process."""
+    global _configured
+    if _configured:
+        return
+    
+    logger.remove()
+    logger.add(sys.stdout, level="DEBUG", format=TEST_LOG_FORMAT)
+    _configured = True
@@ -1,6 +1,7 @@
 """Main entry point for IDENT to AmoCRM integration."""
 
 import argparse
+import signal
 import sys
 import os
 from datetime import datetime, timedelta
@@ -43,6 +44,10 @@ def run_sync_service():
     
     try:
         sync_manager = SyncManager()
+        
+        # Stop cleanly on `docker stop` instead of being killed mid-sleep
+        signal.signal(signal.SIGTERM, lambda signum, frame: sync_manager.stop())
+        
         sync_manager.run()
     except KeyboardInterrupt:
         logger.info("Service interrupted by user")
@@ -2,14 +2,35 @@
 
 import time
 import json
-from typing import Dict, Any, Optional, List
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, Optional, List, Union, Tuple
 from datetime import datetime, timedelta
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
 from loguru import logger
 import redis
 
 from config import amocrm_config, redis_config, app_config, AMOCRM_CONFIG, FIELD_MAPPING
-from src.models import ContactSearchResult, FunnelType
+from src.models import ContactSearchResult, FunnelType, normalize_phone
+
+# Transient failures (rate limits, gateway errors, dropped connections) are
+# retried with full-jitter exponential backoff
+MAX_REQUEST_ATTEMPTS = 5
+RETRY_STATUS_CODES = {429, 502, 503, 504}
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 60.0
+
+# A POST that timed out or hit a gateway error may still have been processed,
+# so resending it could duplicate a contact or deal. Only these methods are
+# retried on any transient failure
+IDEMPOTENT_METHODS = {'GET', 'HEAD', 'PUT', 'PATCH', 'DELETE'}
+
+# Statuses sent before the request was processed, so any method can be resent
+UNPROCESSED_STATUS_CODES = {429, 503}
 
 
 class AmoCRMClient:
@@ -32,10 +53,29 @@ class AmoCRMClient:
             decode_responses=True
         )
         
+        # Keep-alive connection pool shared by concurrent requests
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=app_config.amocrm_max_connections,
+            pool_maxsize=app_config.amocrm_max_connections
+        )
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        
+        # One request pool per client: full sync submits several batches at
+        # once, and they all share these workers, so concurrent requests never
+        # exceed AMOCRM_CONCURRENCY or the pooled connections
+        self.concurrency = max(1, min(app_config.amocrm_concurrency, app_config.amocrm_max_connections))
+        self._executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="amocrm-request")
+        
         # Rate limiting
         self.rate_limit_requests = app_config.rate_limit_requests
         self.rate_limit_period = app_config.rate_limit_period
         self.request_times = []
+        self._rate_limit_lock = threading.Lock()
+        
+        # Refresh tokens are single-use, so concurrent 401s must refresh only once
+        self._token_lock = threading.Lock()
         
         # Load tokens from Redis or config
         self._load_tokens()
@@ -61,49 +101,54 @@ class AmoCRMClient:
     
     def _rate_limit(self):
         """Implement rate limiting."""
-        now = time.time()
-        # Remove requests older than rate limit period
-        self.request_times = [t for t in self.request_times if now - t < self.rate_limit_period]
-        
-        if len(self.request_times) >= self.rate_limit_requests:
-            # Need to wait
-            sleep_time = self.rate_limit_period - (now - self.request_times[0]) + 0.1
-            logger.debug(f"Rate limit reached, sleeping for {sleep_time:.2f} seconds")
-            time.sleep(sleep_time)
-            # Retry
-            self._rate_limit()
-        
-        self.request_times.append(now)
+        # Requests may come from several worker threads
+        with self._rate_limit_lock:
+            while True:
+                now = time.time()
+                # Remove requests older than rate limit period
+                self.request_times = [t for t in self.request_times if now - t < self.rate_limit_period]
+                
+                if len(self.request_times) < self.rate_limit_requests:
+                    break
+                
+                # Need to wait
+                sleep_time = self.rate_limit_period - (now - self.request_times[0]) + 0.1
+                logger.debug(f"Rate limit reached, sleeping for {sleep_time:.2f} seconds")
+                time.sleep(sleep_time)
+            
+            self.request_times.append(now)
     
     def _make_request(self, method: str, endpoint: str, data: Optional[Union[Dict, List]] = None, 
                      params: Optional[Dict] = None, retry_count: int = 0) -> Dict[str, Any]:
         """Make API request with automatic token refresh."""
-        self._rate_limit()
-        
+        access_token = self.access_token
         headers = {
-            'Authorization': f'Bearer {self.access_token}',
+            'Authorization': f'Bearer {access_token}',
             'Content-Type': 'application/json'
         }
         
         url = f"{self.base_url}/{endpoint}"
         
         try:
-            response = requests.request(
-                method=method,
-                url=url,
-                headers=headers,
-                json=data,
-                params=params,
-                timeout=30
+            # orjson encodes nested payloads several times faster than stdlib json
+            response = self._send_with_retry(
+                method,
+                url,
+                headers,
+                orjson.dumps(data) if data is not None else None,
+                params
             )
             
             if response.status_code == 401 and retry_count == 0:
-                # Token expired, try to refresh
-                logger.info("Access token expired, refreshing...")
-                if self.refresh_access_token():
-                    return self._make_request(method, endpoint, data, params, retry_count + 1)
-                else:
-                    raise Exception("Failed to refresh access token")
+                # Token expired, try to refresh unless another worker already did
+                with self._token_lock:
+                    if self.access_token != access_token:
+                        logger.debug("Access token already refreshed by another request")
+                    else:
+                        logger.info("Access token expired, refreshing...")
+                        if not self.refresh_access_token():
+                            raise Exception("Failed to refresh access token")
+                return self._make_request(method, endpoint, data, params, retry_count + 1)
             
             response.raise_for_status()
             return response.json()
@@ -112,6 +157,49 @@ class AmoCRMClient:
             logger.error(f"API request failed: {e}")
             raise
     
+    def _send_with_retry(self, method: str, url: str, headers: Dict[str, str],
+                         body: Optional[bytes], params: Optional[Dict]) -> requests.Response:
+        """Send request, retrying transient failures with jittered exponential backoff."""
+        for attempt in range(1, MAX_REQUEST_ATTEMPTS + 1):
+            self._rate_limit()
+            
+            try:
+                response = self.session.request(
+                    method=method,
+                    url=url,
+                    headers=headers,
+                    data=body,
+                    params=params,
+                    timeout=30
+                )
+                if (response.status_code not in self._retry_status_codes(method)
+                        or attempt == MAX_REQUEST_ATTEMPTS):
+                    return response
+                reason = f"HTTP {response.status_code}"
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                if attempt == MAX_REQUEST_ATTEMPTS or not (
+                        method in IDEMPOTENT_METHODS or self._request_not_sent(e)):
+                    raise
+                reason = str(e)
+            
+            # Full jitter keeps concurrent workers from retrying in lockstep
+            delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+            logger.warning(f"{method} {url} failed ({reason}), retrying in {delay:.1f}s "
+                           f"(attempt {attempt}/{MAX_REQUEST_ATTEMPTS})")
+            time.sleep(delay)
+    
+    @staticmethod
+    def _retry_status_codes(method: str) -> set:
+        """Get the response statuses worth retrying for an HTTP method."""
+        return RETRY_STATUS_CODES if method in IDEMPOTENT_METHODS else UNPROCESSED_STATUS_CODES
+    
+    @staticmethod
+    def _request_not_sent(error: requests.exceptions.RequestException) -> bool:
+        """Check if a request failed before reaching the server (connect timeout or refused)."""
+        if isinstance(error, requests.exceptions.ConnectTimeout):
+            return True
+        return isinstance(getattr(error.args[0] if error.args else None, 'reason', None), NewConnectionError)
+    
     def refresh_access_token(self) -> bool:
         """Refresh access token using refresh token."""
         if not self.refresh_token:
@@ -127,7 +215,7 @@ class AmoCRMClient:
         }
         
         try:
-            response = requests.post(self.oauth_url, json=data, timeout=30)
+            response = self.session.post(self.oauth_url, json=data, timeout=30)
             response.raise_for_status()
             
             token_data = response.json()
@@ -369,12 +457,13 @@ class AmoCRMClient:
             contacts = response.get('_embedded', {}).get('contacts', [])
             
             # Filter contacts that have the exact phone number
+            normalized_phone = self._normalize_phone(phone)
             for contact in contacts:
                 custom_fields = contact.get('custom_fields_values', [])
                 for field in custom_fields:
                     if field.get('field_id') == FIELD_MAPPING["phone"]:
                         for value in field.get('values', []):
-                            if self._normalize_phone(value.get('value', '')) == self._normalize_phone(phone):
+                            if self._normalize_phone(value.get('value', '')) == normalized_phone:
                                 return contact
             
             return None
@@ -439,6 +528,10 @@ class AmoCRMClient:
     
     def create_or_update_contact(self, patient_data: Dict[str, Any]) -> Optional[int]:
         """Create or update contact based on patient data."""
+        return self._create_or_update_contact(patient_data)[0]
+    
+    def _create_or_update_contact(self, patient_data: Dict[str, Any]) -> Tuple[Optional[int], Optional[str]]:
+        """Create or update contact, returning its ID and 'created' or 'updated'."""
         # Extract patient ID and phone from data
         patient_id = None
         phone = None
@@ -451,7 +544,7 @@ class AmoCRMClient:
         
         if not patient_id:
             logger.error("Patient ID not found in data")
-            return None
+            return None, None
         
         # First, try to find by patient ID (primary key)
         existing_contact = self.get_contact_by_custom_field(FIELD_MAPPING["patient_id"], patient_id)
@@ -464,41 +557,71 @@ class AmoCRMClient:
             # Update existing contact
             contact_id = existing_contact['id']
             if self.update_contact(contact_id, patient_data):
-                return contact_id
+                return contact_id, 'updated'
         else:
             # Create new contact
-            return self.create_contact(patient_data)
+            contact_id = self.create_contact(patient_data)
+            if contact_id is not None:
+                return contact_id, 'created'
         
+        return None, None
+    
+    @staticmethod
+    def _contact_phone(contact_data: Dict[str, Any]) -> Optional[str]:
+        """Get the phone number from contact data, if any."""
+        for field in contact_data.get('custom_fields_values', []):
+            if field['field_id'] == FIELD_MAPPING["phone"] and field['values']:
+                return field['values'][0]['value']
         return None
     
     def _normalize_phone(self, phone: str) -> str:
         """Normalize phone number for comparison."""
-        # Remove all non-digit characters
-        return ''.join(filter(str.isdigit, phone))
-    
+        return normalize_phone(phone)
+
     def batch_create_or_update_contacts(self, contacts_data: List[Dict[str, Any]], 
                                       batch_size: int = 50) -> Dict[str, List[int]]:
         """Batch create or update contacts."""
         results = {
             'created': [],
             'updated': [],
-            'failed': []
+            'failed': [],
+            'ids': []  # Contact ID (or None on failure) per input, in input order
         }
         
+        def process(group: List[Dict[str, Any]]) -> List[Tuple[Optional[int], Optional[str]]]:
+            outcomes = []
+            for contact_data in group:
+                try:
+                    outcomes.append(self._create_or_update_contact(contact_data))
+                except Exception as e:
+                    logger.error(f"Failed to process contact: {e}")
+                    outcomes.append((None, None))
+            return outcomes
+        
         # Process in batches to avoid API limits
         for i in range(0, len(contacts_data), batch_size):
             batch = contacts_data[i:i + batch_size]
             
-            for contact_data in batch:
-                try:
-                    contact_id = self.create_or_update_contact(contact_data)
-                    if contact_id:
-                        # Determine if created or updated (simplified)
-                        results['created'].append(contact_id)
-                    else:
-                        results['failed'].append(contact_data)
-                except Exception as e:
-                    logger.error(f"Failed to process contact: {e}")
+            # Contacts sharing a phone (family members) run in order on one
+            # worker, so the second sees the contact the first created
+            groups: Dict[Union[str, int], List[int]] = {}
+            for index, contact_data in enumerate(batch):
+                phone = self._normalize_phone(self._contact_phone(contact_data) or '')
+                groups.setdefault(phone or index, []).append(index)
+            
+            # Groups run on the client's shared request pool, so concurrent
+            # upload batches never add threads beyond AMOCRM_CONCURRENCY
+            outcomes = [(None, None)] * len(batch)
+            group_data = ([batch[index] for index in indexes] for indexes in groups.values())
+            for indexes, group_outcomes in zip(groups.values(), self._executor.map(process, group_data)):
+                for index, outcome in zip(indexes, group_outcomes):
+                    outcomes[index] = outcome
+            
+            for contact_data, (contact_id, action) in zip(batch, outcomes):
+                results['ids'].append(contact_id)
+                if contact_id is not None:
+                    results[action].append(contact_id)
+                else:
                     results['failed'].append(contact_data)
         
         return results
@@ -523,7 +646,7 @@ class AmoCRMClient:
         }
         
         try:
-            response = requests.post(self.oauth_url, json=data, timeout=30)
+            response = self.session.post(self.oauth_url, json=data, timeout=30)
             response.raise_for_status()
             
             token_data = response.json()
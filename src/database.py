@@ -1,13 +1,99 @@
 """Database connection and operations for IDENT system."""
 
+import queue
 import pyodbc
-from typing import List, Optional, Dict, Any, Tuple
+from contextlib import contextmanager
+from typing import List, Optional, Dict, Any, Tuple, Iterator
 from datetime import datetime, timedelta
 from loguru import logger
 
 from config import db_config
 from src.models import Patient, Person, Gender, PatientStatus, Reception, ReceptionStatus
 
+# Most IDs bound into one IN (...) list; SQL Server allows 2100 parameters
+MAX_IN_PARAMS = 2000
+
+# Every patient query selects the same leading columns, in this order, so
+# _row_to_patient can unpack them positionally:
+# ID_Patients, ID_Persons, FirstVisit, CardNumber, Comment, PatientNumber,
+# Status, ID_ArchiveReasons, ID_Branches, DateTimeChanged, Surname, Name,
+# Patronymic, Sex, Birthday, Phone, MobilePhone, Email, City, INN, SNILS,
+# Passport, Age, PersonChanged
+PATIENT_COLUMN_COUNT = 24
+
+# Single-patient lookup with its dimension names and details folded in, so
+# one round-trip builds the whole Patient; kept as one constant so repeated
+# calls send identical SQL text and hit the driver's statement cache and
+# SQL Server's plan cache
+_PATIENT_BY_ID_QUERY = """
+SELECT 
+    p.ID_Patients,
+    p.ID_Persons,
+    p.FirstVisit,
+    p.CardNumber,
+    p.Comment,
+    p.PatientNumber,
+    p.Status,
+    p.ID_ArchiveReasons,
+    p.ID_Branches,
+    p.DateTimeChanged,
+    per.Surname,
+    per.Name,
+    per.Patronymic,
+    per.Sex,
+    per.Birthday,
+    per.Phone,
+    per.MobilePhone,
+    per.Email,
+    per.City,
+    per.INN,
+    per.SNILS,
+    per.Passport,
+    per.Age,
+    per.DateTimeChanged as PersonChanged,
+    ar.Name as ArchiveReason,
+    br.Name as BranchName,
+    disc.DiscountPercent,
+    rec.ReceptionCount,
+    rec.VisitCount,
+    pay.TotalPayments,
+    cost.TotalCost
+FROM Patients p
+LEFT JOIN Persons per ON p.ID_Persons = per.ID
+LEFT JOIN ArchiveReasons ar ON p.ID_ArchiveReasons = ar.ID
+LEFT JOIN Branches br ON p.ID_Branches = br.ID
+OUTER APPLY (
+    SELECT TOP 1 DiscountPercent
+    FROM PatientDiscounts
+    WHERE ID_Patients = p.ID_Patients
+    ORDER BY DateCreated DESC
+) disc
+OUTER APPLY (
+    SELECT 
+        COUNT(*) as ReceptionCount,
+        SUM(CASE WHEN Status IN (2, 3, 4) THEN 1 ELSE 0 END) as VisitCount  -- Completed statuses
+    FROM Receptions
+    WHERE ID_Patients = p.ID_Patients
+) rec
+OUTER APPLY (
+    SELECT SUM(Amount) as TotalPayments
+    FROM Payments
+    WHERE ID_Patients = p.ID_Patients
+    AND Status = 1  -- Confirmed payments
+) pay
+OUTER APPLY (
+    SELECT SUM(t.Cost) as TotalCost
+    FROM Treatments t
+    INNER JOIN Receptions r ON t.ID_Receptions = r.ID
+    WHERE r.ID_Patients = p.ID_Patients
+    AND t.Status = 1  -- Completed treatments
+) cost
+WHERE p.ID_Patients = ?
+"""
+
+# Connections returned by disconnect() and handed out again by connect(), so the
+# once-a-minute syncs reuse a logged-in session instead of opening a new one
+_idle_connections: queue.LifoQueue = queue.LifoQueue(maxsize=max(db_config.pool_size, 1))
 
 class IdentDatabase:
     """IDENT database operations."""
@@ -17,6 +103,11 @@ class IdentDatabase:
         self.connection_string = db_config.connection_string
         self._connection = None
         self._cursor = None
+        self._in_transaction = False
+        
+        # Per-connection memo of the small, near-static dimension tables
+        self._archive_reasons: Dict[int, Optional[str]] = {}
+        self._branches: Dict[int, Optional[str]] = {}
     
     def __enter__(self):
         """Context manager entry."""
@@ -25,28 +116,156 @@ class IdentDatabase:
     
     def __exit__(self, exc_type, exc_val, exc_tb):
         """Context manager exit."""
-        self.disconnect()
+        # A driver error may have left the connection unusable, so don't pool it
+        self.disconnect(discard=isinstance(exc_val, pyodbc.Error))
     
     def connect(self):
-        """Establish database connection."""
+        """Establish database connection, reusing an idle pooled one when available."""
         try:
-            self._connection = pyodbc.connect(self.connection_string)
+            self._connection = self._take_idle_connection() or pyodbc.connect(self.connection_string)
             self._cursor = self._connection.cursor()
+            self._archive_reasons.clear()
+            self._branches.clear()
             logger.info("Connected to IDENT database")
         except Exception as e:
             logger.error(f"Failed to connect to database: {e}")
             raise
     
-    def disconnect(self):
-        """Close database connection."""
+    @contextmanager
+    def transaction(self):
+        """Group several sync-state writes into one commit."""
+        if self._in_transaction:
+            yield
+            return
+        
+        self._in_transaction = True
+        try:
+            yield
+            self._connection.commit()
+        except Exception:
+            self._connection.rollback()
+            raise
+        finally:
+            self._in_transaction = False
+    
+    def _commit(self):
+        """Commit unless an enclosing transaction() will."""
+        if not self._in_transaction:
+            self._connection.commit()
+    
+    def disconnect(self, discard: bool = False):
+        """Release database connection back to the pool, or close it."""
         if self._cursor:
             self._cursor.close()
+            self._cursor = None
         if self._connection:
-            self._connection.close()
+            if discard or not self._release_connection(self._connection):
+                self._connection.close()
+            self._connection = None
         logger.info("Disconnected from IDENT database")
     
+    @staticmethod
+    def _take_idle_connection() -> Optional[pyodbc.Connection]:
+        """Take a pooled connection that still answers, closing any that don't."""
+        while True:
+            try:
+                connection = _idle_connections.get_nowait()
+            except queue.Empty:
+                return None
+            
+            try:
+                connection.execute("SELECT 1").fetchone()
+                return connection
+            except pyodbc.Error as e:
+                logger.debug(f"Dropping stale pooled connection: {e}")
+                connection.close()
+    
+    @staticmethod
+    def _release_connection(connection: pyodbc.Connection) -> bool:
+        """Return a connection to the pool, discarding any uncommitted work."""
+        if db_config.pool_size <= 0:
+            return False
+        
+        try:
+            connection.rollback()
+            _idle_connections.put_nowait(connection)
+            return True
+        except (pyodbc.Error, queue.Full):
+            return False
+    
+    def get_patient(self, patient_id: int) -> Optional[Patient]:
+        """Get a single patient by ID."""
+        self._cursor.execute(_PATIENT_BY_ID_QUERY, patient_id)
+        row = self._cursor.fetchone()
+        
+        if not row:
+            return None
+        
+        # Seed the dimension memo from the joined names so no lookups follow
+        if row.ID_ArchiveReasons:
+            self._archive_reasons[row.ID_ArchiveReasons] = row.ArchiveReason
+        if row.ID_Branches:
+            self._branches[row.ID_Branches] = row.BranchName
+        
+        patient = self._row_to_patient(row)
+        self._apply_patient_details(
+            patient, row.DiscountPercent, row.ReceptionCount, row.VisitCount,
+            row.TotalPayments, row.TotalCost
+        )
+        return patient
+    
+    def get_patients(self, patient_ids: List[int]) -> List[Patient]:
+        """Get several patients by ID in one query per chunk; missing or deleted ones are left out."""
+        rows = self._fetch_by_patient_ids("""
+            SELECT 
+                p.ID_Patients,
+                p.ID_Persons,
+                p.FirstVisit,
+                p.CardNumber,
+                p.Comment,
+                p.PatientNumber,
+                p.Status,
+                p.ID_ArchiveReasons,
+                p.ID_Branches,
+                p.DateTimeChanged,
+                per.Surname,
+                per.Name,
+                per.Patronymic,
+                per.Sex,
+                per.Birthday,
+                per.Phone,
+                per.MobilePhone,
+                per.Email,
+                per.City,
+                per.INN,
+                per.SNILS,
+                per.Passport,
+                per.Age,
+                per.DateTimeChanged as PersonChanged
+            FROM Patients p
+            LEFT JOIN Persons per ON p.ID_Persons = per.ID
+            WHERE p.ID_Patients IN ({ids})
+            AND p.Status != 3  -- Exclude deleted patients
+        """, patient_ids)
+        
+        patients = [self._row_to_patient(row) for row in rows.values()]
+        self._load_patient_details(patients)
+        return patients
+    
     def get_all_patients(self, limit: Optional[int] = None) -> List[Patient]:
         """Get all patients for initial sync."""
+        patients = list(self.iter_all_patients(limit=limit))
+        logger.info(f"Fetched {len(patients)} patients from database")
+        return patients
+    
+    def iter_all_patients(self, batch_size: int = 50, limit: Optional[int] = None) -> Iterator[Patient]:
+        """Stream all patients from a forward-only server cursor."""
+        for patients in self.iter_patient_batches(batch_size, limit):
+            yield from patients
+    
+    def iter_patient_batches(self, batch_size: int = 50,
+                             limit: Optional[int] = None) -> Iterator[List[Patient]]:
+        """Stream all patients as lists of up to batch_size, one fetch per list."""
         query = """
         SELECT 
             p.ID_Patients,
@@ -71,7 +290,8 @@ class IdentDatabase:
             per.INN,
             per.SNILS,
             per.Passport,
-            per.Age
+            per.Age,
+            per.DateTimeChanged as PersonChanged
         FROM Patients p
         LEFT JOIN Persons per ON p.ID_Persons = per.ID
         WHERE p.Status != 3  -- Exclude deleted patients
@@ -80,57 +300,33 @@ class IdentDatabase:
         if limit:
             query += f" ORDER BY p.ID_Patients OFFSET 0 ROWS FETCH NEXT {limit} ROWS ONLY"
         
-        self._cursor.execute(query)
-        patients = []
-        
-        for row in self._cursor.fetchall():
-            person = Person(
-                id=row.ID_Persons,
-                surname=row.Surname or "",
-                name=row.Name or "",
-                patronymic=row.Patronymic,
-                sex=Gender(row.Sex or 0),
-                birthday=row.Birthday,
-                phone=row.Phone,
-                mobile_phone=row.MobilePhone,
-                email=row.Email,
-                city=row.City,
-                inn=row.INN,
-                snils=row.SNILS,
-                passport=row.Passport,
-                age=row.Age,
-                date_time_changed=row.DateTimeChanged
-            )
-            
-            patient = Patient(
-                id_patient=row.ID_Patients,
-                id_persons=row.ID_Persons,
-                first_visit=row.FirstVisit,
-                card_number=row.CardNumber,
-                comment=row.Comment,
-                patient_number=row.PatientNumber,
-                status=PatientStatus(row.Status or 1),
-                archive_reason=self._get_archive_reason(row.ID_ArchiveReasons),
-                branch=self._get_branch_name(row.ID_Branches),
-                person=person,
-                last_updated=row.DateTimeChanged
-            )
-            
-            # Get additional patient data
-            patient.discount = self._get_patient_discount(row.ID_Patients)
-            patient.total_visits = self._get_patient_visits_count(row.ID_Patients)
-            patient.advance, patient.debt = self._get_patient_balance(row.ID_Patients)
-            patient.completed_receptions_count = self.get_patient_completed_receptions_count(row.ID_Patients)
-            
-            patients.append(patient)
-        
-        logger.info(f"Fetched {len(patients)} patients from database")
-        return patients
+        for rows in self._stream_row_chunks(query, batch_size=batch_size):
+            patients = [self._row_to_patient(row) for row in rows]
+            self._load_patient_details(patients)
+            yield patients
     
-    def get_changed_patients(self, since: datetime, limit: Optional[int] = None) -> List[Patient]:
-        """Get patients changed since specified date."""
+    def get_changed_patients_page(self, after_changed: datetime, after_id: int, limit: int
+                                  ) -> Tuple[List[Patient], Dict[int, datetime], Dict[int, Tuple[int, bytes]]]:
+        """Get the next page of changed patients after a (changed, id) keyset position, with their sync state."""
+        # Each side of the UNION ALL is a range seek on its own DateTimeChanged
+        # (both columns need an index), so only rows changed since the cursor
+        # are read; their later change time is the patient's keyset value
         query = """
-        SELECT 
+        WITH changed AS (
+            SELECT ID_Patients, DateTimeChanged AS ChangedAt
+            FROM Patients
+            WHERE DateTimeChanged >= ?
+            UNION ALL
+            SELECT p.ID_Patients, per.DateTimeChanged
+            FROM Persons per
+            INNER JOIN Patients p ON p.ID_Persons = per.ID
+            WHERE per.DateTimeChanged >= ?
+        ), chg AS (
+            SELECT ID_Patients, MAX(ChangedAt) AS ChangedAt
+            FROM changed
+            GROUP BY ID_Patients
+        )
+        SELECT TOP (?)
             p.ID_Patients,
             p.ID_Persons,
             p.FirstVisit,
@@ -154,62 +350,187 @@ class IdentDatabase:
             per.SNILS,
             per.Passport,
             per.Age,
-            per.DateTimeChanged as PersonChanged
-        FROM Patients p
+            per.DateTimeChanged as PersonChanged,
+            chg.ChangedAt,
+            ss.last_sync,
+            ss.amocrm_contact_id,
+            ss.payload_hash
+        FROM chg
+        INNER JOIN Patients p ON p.ID_Patients = chg.ID_Patients
         LEFT JOIN Persons per ON p.ID_Persons = per.ID
-        WHERE (p.DateTimeChanged >= ? OR per.DateTimeChanged >= ?)
+        LEFT JOIN SyncState ss ON ss.patient_id = p.ID_Patients AND ss.sync_status = 'success'
+        WHERE (chg.ChangedAt > ? OR (chg.ChangedAt = ? AND chg.ID_Patients > ?))
         AND p.Status != 3  -- Exclude deleted patients
+        ORDER BY chg.ChangedAt, chg.ID_Patients
         """
         
-        if limit:
-            query += f" ORDER BY p.DateTimeChanged DESC OFFSET 0 ROWS FETCH NEXT {limit} ROWS ONLY"
-        
-        self._cursor.execute(query, since, since)
-        patients = []
-        
-        for row in self._cursor.fetchall():
-            person = Person(
-                id=row.ID_Persons,
-                surname=row.Surname or "",
-                name=row.Name or "",
-                patronymic=row.Patronymic,
-                sex=Gender(row.Sex or 0),
-                birthday=row.Birthday,
-                phone=row.Phone,
-                mobile_phone=row.MobilePhone,
-                email=row.Email,
-                city=row.City,
-                inn=row.INN,
-                snils=row.SNILS,
-                passport=row.Passport,
-                age=row.Age,
-                date_time_changed=row.PersonChanged
-            )
+        params = (after_changed, after_changed, limit, after_changed, after_changed, after_id)
+        try:
+            self._cursor.execute(query, *params)
+        except pyodbc.ProgrammingError:
+            # SyncState is missing or predates payload_hash; bring it up to date
+            self.has_any_sync_state()
+            self._add_payload_hash_column()
+            self._cursor.execute(query, *params)
+        rows = self._cursor.fetchall()
+        
+        patients = [self._row_to_patient(row, row[PATIENT_COLUMN_COUNT]) for row in rows]
+        self._load_patient_details(patients)
+        
+        # Sync state comes from the joined SyncState columns, so no separate read is needed
+        sync_state = {row.ID_Patients: row.last_sync for row in rows if row.last_sync is not None}
+        payload_hashes = {row.ID_Patients: (row.amocrm_contact_id, bytes(row.payload_hash))
+                          for row in rows if row.payload_hash is not None}
+        return patients, sync_state, payload_hashes
+    
+    def _stream_row_chunks(self, query: str, *params, batch_size: int = 50) -> Iterator[List[Any]]:
+        """Yield rows of a query in arraysize chunks."""
+        # Dedicated cursor so per-patient lookups can keep using the shared
+        # one while the scan is open (requires MARS on the connection)
+        cursor = self._connection.cursor()
+        cursor.arraysize = batch_size
+        try:
+            cursor.execute(query, *params)
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield rows
+        finally:
+            cursor.close()
+    
+    def _row_to_patient(self, row: Any, last_updated: Optional[datetime] = None) -> Patient:
+        """Build a Patient from a patient/person row (details loaded separately)."""
+        # Unpack the shared column prefix once; attribute access on a pyodbc
+        # Row resolves the column name on every lookup
+        (id_patient, id_persons, first_visit, card_number, comment, patient_number,
+         status, archive_reason_id, branch_id, patient_changed,
+         surname, name, patronymic, sex, birthday, phone, mobile_phone, email,
+         city, inn, snils, passport, age, person_changed) = row[:PATIENT_COLUMN_COUNT]
+        
+        if last_updated is None:
+            last_updated = max(patient_changed or datetime.min, person_changed or datetime.min)
+        
+        person = Person(
+            id=id_persons,
+            surname=surname or "",
+            name=name or "",
+            patronymic=patronymic,
+            sex=Gender(sex or 0),
+            birthday=birthday,
+            phone=phone,
+            mobile_phone=mobile_phone,
+            email=email,
+            city=city,
+            inn=inn,
+            snils=snils,
+            passport=passport,
+            age=age,
+            date_time_changed=person_changed
+        )
+        
+        patient = Patient(
+            id_patient=id_patient,
+            id_persons=id_persons,
+            first_visit=first_visit,
+            card_number=card_number,
+            comment=comment,
+            patient_number=patient_number,
+            status=PatientStatus(status or 1),
+            archive_reason=self._get_archive_reason(archive_reason_id),
+            branch=self._get_branch_name(branch_id),
+            person=person,
+            last_updated=last_updated
+        )
+        
+        return patient
+    
+    def _load_patient_details(self, patients: List[Patient]):
+        """Fill discount, visits, balance and reception counts for a batch of patients."""
+        if not patients:
+            return
+        
+        ids = [patient.id_patient for patient in patients]
+        
+        discounts = self._fetch_by_patient_ids("""
+            SELECT ID_Patients, DiscountPercent
+            FROM (
+                SELECT 
+                    ID_Patients,
+                    DiscountPercent,
+                    ROW_NUMBER() OVER (PARTITION BY ID_Patients ORDER BY DateCreated DESC) AS rn
+                FROM PatientDiscounts
+                WHERE ID_Patients IN ({ids})
+            ) d
+            WHERE rn = 1
+        """, ids)
+        
+        reception_counts = self._fetch_by_patient_ids("""
+            SELECT 
+                ID_Patients,
+                COUNT(*) as ReceptionCount,
+                SUM(CASE WHEN Status IN (2, 3, 4) THEN 1 ELSE 0 END) as VisitCount  -- Completed statuses
+            FROM Receptions
+            WHERE ID_Patients IN ({ids})
+            GROUP BY ID_Patients
+        """, ids)
+        
+        payments = self._fetch_by_patient_ids("""
+            SELECT ID_Patients, SUM(Amount) as TotalPayments
+            FROM Payments
+            WHERE ID_Patients IN ({ids})
+            AND Status = 1  -- Confirmed payments
+            GROUP BY ID_Patients
+        """, ids)
+        
+        costs = self._fetch_by_patient_ids("""
+            SELECT r.ID_Patients, SUM(t.Cost) as TotalCost
+            FROM Treatments t
+            INNER JOIN Receptions r ON t.ID_Receptions = r.ID
+            WHERE r.ID_Patients IN ({ids})
+            AND t.Status = 1  -- Completed treatments
+            GROUP BY r.ID_Patients
+        """, ids)
+        
+        for patient in patients:
+            pid = patient.id_patient
+            discount_row = discounts.get(pid)
+            counts_row = reception_counts.get(pid)
+            payments_row = payments.get(pid)
+            costs_row = costs.get(pid)
             
-            patient = Patient(
-                id_patient=row.ID_Patients,
-                id_persons=row.ID_Persons,
-                first_visit=row.FirstVisit,
-                card_number=row.CardNumber,
-                comment=row.Comment,
-                patient_number=row.PatientNumber,
-                status=PatientStatus(row.Status or 1),
-                archive_reason=self._get_archive_reason(row.ID_ArchiveReasons),
-                branch=self._get_branch_name(row.ID_Branches),
-                person=person,
-                last_updated=max(row.DateTimeChanged or datetime.min, row.PersonChanged or datetime.min)
+            self._apply_patient_details(
+                patient,
+                discount_row.DiscountPercent if discount_row else None,
+                counts_row.ReceptionCount if counts_row else None,
+                counts_row.VisitCount if counts_row else None,
+                payments_row.TotalPayments if payments_row else None,
+                costs_row.TotalCost if costs_row else None
             )
-            
-            # Get additional patient data
-            patient.discount = self._get_patient_discount(row.ID_Patients)
-            patient.total_visits = self._get_patient_visits_count(row.ID_Patients)
-            patient.advance, patient.debt = self._get_patient_balance(row.ID_Patients)
-            patient.completed_receptions_count = self.get_patient_completed_receptions_count(row.ID_Patients)
-            
-            patients.append(patient)
+    
+    def _apply_patient_details(self, patient: Patient, discount: Any, reception_count: Optional[int],
+                               visit_count: Optional[int], total_payments: Any, total_cost: Any):
+        """Set discount, visits, balance and reception counts from raw aggregate values."""
+        patient.discount = float(discount) if discount else 0.0
+        patient.total_visits = visit_count or 0
+        patient.completed_receptions_count = reception_count or 0
+        patient.advance, patient.debt = self._split_balance(
+            float(total_payments) if total_payments else 0.0,
+            float(total_cost) if total_cost else 0.0
+        )
+    
+    def _fetch_by_patient_ids(self, query: str, ids: List[int]) -> Dict[int, Any]:
+        """Run a per-patient aggregate for many IDs, keyed by the first column."""
+        result = {}
         
-        logger.info(f"Fetched {len(patients)} changed patients since {since}")
-        return patients
+        # Stay under SQL Server's 2100 parameters per request
+        for i in range(0, len(ids), MAX_IN_PARAMS):
+            chunk = ids[i:i + MAX_IN_PARAMS]
+            self._cursor.execute(query.format(ids=",".join("?" * len(chunk))), *chunk)
+            for row in self._cursor.fetchall():
+                result[row[0]] = row
+        
+        return result
     
     def get_receptions(self, since: Optional[datetime] = None) -> List[Reception]:
         """Get receptions from both Receptions and ScheduledReceptions tables."""
@@ -221,6 +542,21 @@ class IdentDatabase:
         
         return all_receptions
     
+    def has_reception_changes(self, since: datetime) -> bool:
+        """Check whether any completed or scheduled reception changed since the given time."""
+        query = """
+        SELECT CASE WHEN EXISTS (
+            SELECT 1 FROM Receptions WHERE DateTimeChanged >= ?
+        ) OR EXISTS (
+            SELECT 1 FROM ScheduledReceptions
+            WHERE ID_ReceptionCancelReasons IS NULL
+              AND (DateTimeAdded >= ? OR DateTimeChanged >= ?)
+        ) THEN 1 ELSE 0 END
+        """
+        
+        self._cursor.execute(query, since, since, since)
+        return bool(self._cursor.fetchone()[0])
+    
     def _get_completed_receptions(self, since: Optional[datetime] = None) -> List[Reception]:
         """Get completed receptions from Receptions table."""
         query = """
@@ -350,73 +686,43 @@ class IdentDatabase:
             logger.error(f"Failed to get completed receptions count for patient {patient_id}: {e}")
             return 0
     
+    def load_dimensions(self):
+        """Preload archive reason and branch names for this connection in two queries."""
+        self._cursor.execute("SELECT ID, Name FROM ArchiveReasons")
+        self._archive_reasons.update((row.ID, row.Name) for row in self._cursor.fetchall())
+        
+        self._cursor.execute("SELECT ID, Name FROM Branches")
+        self._branches.update((row.ID, row.Name) for row in self._cursor.fetchall())
+        
+        logger.debug(f"Loaded {len(self._archive_reasons)} archive reasons and {len(self._branches)} branches")
+    
     def _get_archive_reason(self, reason_id: Optional[int]) -> Optional[str]:
         """Get archive reason by ID."""
         if not reason_id:
             return None
         
-        self._cursor.execute("SELECT Name FROM ArchiveReasons WHERE ID = ?", reason_id)
-        row = self._cursor.fetchone()
-        return row.Name if row else None
+        if reason_id not in self._archive_reasons:
+            self._cursor.execute("SELECT Name FROM ArchiveReasons WHERE ID = ?", reason_id)
+            row = self._cursor.fetchone()
+            self._archive_reasons[reason_id] = row.Name if row else None
+        
+        return self._archive_reasons[reason_id]
     
     def _get_branch_name(self, branch_id: Optional[int]) -> Optional[str]:
         """Get branch name by ID."""
         if not branch_id:
             return None
         
-        self._cursor.execute("SELECT Name FROM Branches WHERE ID = ?", branch_id)
-        row = self._cursor.fetchone()
-        return row.Name if row else None
-    
-    def _get_patient_discount(self, patient_id: int) -> float:
-        """Get patient discount percentage."""
-        self._cursor.execute("""
-            SELECT TOP 1 DiscountPercent 
-            FROM PatientDiscounts 
-            WHERE ID_Patients = ? 
-            ORDER BY DateCreated DESC
-        """, patient_id)
-        
-        row = self._cursor.fetchone()
-        return float(row.DiscountPercent) if row and row.DiscountPercent else 0.0
-    
-    def _get_patient_visits_count(self, patient_id: int) -> int:
-        """Get total visits count for patient."""
-        self._cursor.execute("""
-            SELECT COUNT(*) as VisitCount
-            FROM Receptions
-            WHERE ID_Patients = ?
-            AND Status IN (2, 3, 4)  -- Completed statuses
-        """, patient_id)
+        if branch_id not in self._branches:
+            self._cursor.execute("SELECT Name FROM Branches WHERE ID = ?", branch_id)
+            row = self._cursor.fetchone()
+            self._branches[branch_id] = row.Name if row else None
         
-        row = self._cursor.fetchone()
-        return row.VisitCount if row else 0
+        return self._branches[branch_id]
     
-    def _get_patient_balance(self, patient_id: int) -> Tuple[float, float]:
-        """Get patient financial balance (advance, debt)."""
-        # Get total payments
-        self._cursor.execute("""
-            SELECT SUM(Amount) as TotalPayments
-            FROM Payments
-            WHERE ID_Patients = ?
-            AND Status = 1  -- Confirmed payments
-        """, patient_id)
-        
-        payments_row = self._cursor.fetchone()
-        total_payments = float(payments_row.TotalPayments) if payments_row and payments_row.TotalPayments else 0.0
-        
-        # Get total treatment costs
-        self._cursor.execute("""
-            SELECT SUM(t.Cost) as TotalCost
-            FROM Treatments t
-            INNER JOIN Receptions r ON t.ID_Receptions = r.ID
-            WHERE r.ID_Patients = ?
-            AND t.Status = 1  -- Completed treatments
-        """, patient_id)
-        
-        costs_row = self._cursor.fetchone()
-        total_costs = float(costs_row.TotalCost) if costs_row and costs_row.TotalCost else 0.0
-        
+    @staticmethod
+    def _split_balance(total_payments: float, total_costs: float) -> Tuple[float, float]:
+        """Split a payment/cost balance into (advance, debt)."""
         balance = total_payments - total_costs
         
         if balance > 0:
@@ -424,48 +730,180 @@ class IdentDatabase:
         else:
             return 0.0, abs(balance)  # no advance, debt
     
-    def get_sync_state(self) -> Dict[int, Dict[str, Any]]:
-        """Get synchronization state from database."""
+    def get_funnel_counts(self) -> Tuple[int, int]:
+        """Count (primary, secondary) funnel patients, i.e. without and with receptions."""
+        self._cursor.execute("""
+            SELECT 
+                COUNT(*) AS TotalPatients,
+                COUNT(r.ID_Patients) AS SecondaryPatients
+            FROM Patients p
+            LEFT JOIN (SELECT DISTINCT ID_Patients FROM Receptions) r ON r.ID_Patients = p.ID_Patients
+            WHERE p.Status != 3  -- Exclude deleted patients
+        """)
+        
+        row = self._cursor.fetchone()
+        return row.TotalPatients - row.SecondaryPatients, row.SecondaryPatients
+    
+    def has_any_sync_state(self) -> bool:
+        """Check whether any patient has been synchronized yet."""
+        try:
+            self._cursor.execute("SELECT TOP 1 1 FROM SyncState")
+            return self._cursor.fetchone() is not None
+        except pyodbc.ProgrammingError:
+            # Table doesn't exist, create it
+            self._create_sync_state_table()
+            return False
+    
+    def get_payload_hashes(self) -> Dict[int, Tuple[int, bytes]]:
+        """Get (contact_id, payload_hash) of the last successfully sent payload per patient."""
         try:
             self._cursor.execute("""
-                SELECT patient_id, last_sync, amocrm_contact_id, sync_status
+                SELECT patient_id, amocrm_contact_id, payload_hash
                 FROM SyncState
+                WHERE sync_status = 'success'
+                AND payload_hash IS NOT NULL
             """)
             
-            state = {}
-            for row in self._cursor.fetchall():
-                state[row.patient_id] = {
-                    'last_sync': row.last_sync,
-                    'amocrm_contact_id': row.amocrm_contact_id,
-                    'sync_status': row.sync_status
-                }
-            
-            return state
+            return {row.patient_id: (row.amocrm_contact_id, bytes(row.payload_hash))
+                    for row in self._cursor.fetchall()}
         except pyodbc.ProgrammingError:
-            # Table doesn't exist, create it
-            self._create_sync_state_table()
+            # SyncState is missing or predates payload_hash; bring it up to date
+            self.has_any_sync_state()
+            self._add_payload_hash_column()
             return {}
     
-    def update_sync_state(self, patient_id: int, amocrm_contact_id: int, status: str = "success"):
+    def update_sync_state(self, patient_id: int, amocrm_contact_id: int, status: str = "success",
+                          payload_hash: Optional[bytes] = None):
         """Update synchronization state."""
+        self.bulk_update_sync_state([(patient_id, amocrm_contact_id, status, payload_hash)])
+    
+    def bulk_update_sync_state(self, rows: List[Tuple[int, int, str, Optional[bytes]]]) -> bool:
+        """Update synchronization state for many (patient_id, contact_id, status, payload_hash) rows at once."""
+        if not rows:
+            return True
+        
+        cursor = self._connection.cursor()
+        # Send the whole parameter array in one round-trip
+        cursor.fast_executemany = True
         try:
-            self._cursor.execute("""
+            cursor.executemany("""
                 MERGE SyncState AS target
-                USING (SELECT ? AS patient_id) AS source
+                USING (SELECT ? AS patient_id, ? AS amocrm_contact_id, ? AS sync_status,
+                              CAST(? AS VARBINARY(16)) AS payload_hash) AS source
                 ON target.patient_id = source.patient_id
                 WHEN MATCHED THEN
                     UPDATE SET 
                         last_sync = GETDATE(),
-                        amocrm_contact_id = ?,
-                        sync_status = ?
+                        amocrm_contact_id = source.amocrm_contact_id,
+                        sync_status = source.sync_status,
+                        payload_hash = source.payload_hash,
+                        error_message = NULL,
+                        retry_count = 0
                 WHEN NOT MATCHED THEN
-                    INSERT (patient_id, last_sync, amocrm_contact_id, sync_status)
-                    VALUES (?, GETDATE(), ?, ?);
-            """, patient_id, amocrm_contact_id, status, patient_id, amocrm_contact_id, status)
+                    INSERT (patient_id, last_sync, amocrm_contact_id, sync_status, payload_hash)
+                    VALUES (source.patient_id, GETDATE(), source.amocrm_contact_id, source.sync_status,
+                            source.payload_hash);
+            """, rows)
             
-            self._connection.commit()
-        except Exception as e:
-            logger.error(f"Failed to update sync state: {e}")
+            self._commit()
+            return True
+        except pyodbc.Error as e:
+            # Rows not marked as synced are picked up again on the next pass
+            logger.error(f"Sync-state upsert for {len(rows)} patients failed, will retry on next pass: {e}")
+            if self._in_transaction:
+                raise
+            self._connection.rollback()
+            return False
+        finally:
+            cursor.close()
+    
+    def bulk_record_sync_failures(self, rows: List[Tuple[int, str]]):
+        """Mark many (patient_id, error) rows as failed and bump their retry count."""
+        if not rows:
+            return
+        
+        cursor = self._connection.cursor()
+        cursor.fast_executemany = True
+        try:
+            cursor.executemany("""
+                MERGE SyncState AS target
+                USING (SELECT ? AS patient_id, ? AS error_message) AS source
+                ON target.patient_id = source.patient_id
+                WHEN MATCHED THEN
+                    UPDATE SET 
+                        last_sync = GETDATE(),
+                        sync_status = 'failed',
+                        error_message = source.error_message,
+                        retry_count = ISNULL(target.retry_count, 0) + 1
+                WHEN NOT MATCHED THEN
+                    INSERT (patient_id, last_sync, sync_status, error_message, retry_count)
+                    VALUES (source.patient_id, GETDATE(), 'failed', source.error_message, 1);
+            """, rows)
+            
+            self._commit()
+        except pyodbc.Error as e:
+            logger.error(f"Failed to record sync failures for {len(rows)} patients: {e}")
+            if self._in_transaction:
+                raise
+            self._connection.rollback()
+        finally:
+            cursor.close()
+    
+    def get_patients_due_for_retry(self, max_attempts: int, limit: int) -> List[int]:
+        """Get failed patients whose exponential backoff (2^retries minutes) has elapsed."""
+        try:
+            self._cursor.execute("""
+                SELECT TOP (?) patient_id
+                FROM SyncState
+                WHERE sync_status = 'failed'
+                AND retry_count < ?
+                AND DATEADD(MINUTE, POWER(2, retry_count), last_sync) <= GETDATE()
+                ORDER BY last_sync
+            """, limit, max_attempts)
+            
+            return [row.patient_id for row in self._cursor.fetchall()]
+        except pyodbc.ProgrammingError:
+            # Table doesn't exist, create it
+            self._create_sync_state_table()
+            return []
+    
+    def get_sync_cursor(self, name: str) -> Optional[Tuple[datetime, int]]:
+        """Get the saved (changed, id) high-water mark for an incremental sync."""
+        try:
+            self._cursor.execute("""
+                SELECT last_changed, last_id
+                FROM SyncCursor
+                WHERE name = ?
+            """, name)
+            
+            row = self._cursor.fetchone()
+            return (row.last_changed, row.last_id) if row else None
+        except pyodbc.ProgrammingError:
+            # Table doesn't exist, create it
+            self._create_sync_cursor_table()
+            return None
+    
+    def update_sync_cursor(self, name: str, last_changed: datetime, last_id: int):
+        """Save the (changed, id) high-water mark for an incremental sync."""
+        try:
+            self._cursor.execute("""
+                MERGE SyncCursor AS target
+                USING (SELECT ? AS name) AS source
+                ON target.name = source.name
+                WHEN MATCHED THEN
+                    UPDATE SET 
+                        last_changed = ?,
+                        last_id = ?
+                WHEN NOT MATCHED THEN
+                    INSERT (name, last_changed, last_id)
+                    VALUES (?, ?, ?);
+            """, name, last_changed, last_id, name, last_changed, last_id)
+            
+            self._commit()
+        except pyodbc.Error as e:
+            logger.error(f"Failed to update sync cursor: {e}")
+            if self._in_transaction:
+                raise
             self._connection.rollback()
     
     def _create_sync_state_table(self):
@@ -477,8 +915,30 @@ class IdentDatabase:
                 amocrm_contact_id INT,
                 sync_status VARCHAR(50),
                 error_message NVARCHAR(MAX),
-                retry_count INT DEFAULT 0
+                retry_count INT DEFAULT 0,
+                payload_hash VARBINARY(16)
+            )
+        """)
+        self._connection.commit()
+        logger.info("Created SyncState table") 
+    
+    def _add_payload_hash_column(self):
+        """Add the payload_hash column to a SyncState table created before it existed."""
+        self._cursor.execute("""
+            IF COL_LENGTH('SyncState', 'payload_hash') IS NULL
+                ALTER TABLE SyncState ADD payload_hash VARBINARY(16)
+        """)
+        self._connection.commit()
+        logger.info("Added payload_hash column to SyncState table")
+    
+    def _create_sync_cursor_table(self):
+        """Create sync cursor table if it doesn't exist."""
+        self._cursor.execute("""
+            CREATE TABLE SyncCursor (
+                name VARCHAR(50) PRIMARY KEY,
+                last_changed DATETIME NOT NULL,
+                last_id INT NOT NULL
             )
         """)
         self._connection.commit()
-        logger.info("Created SyncState table") 
\ No newline at end of file
+        logger.info("Created SyncCursor table")
\ No newline at end of file
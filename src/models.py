@@ -1,12 +1,42 @@
 """Data models for IDENT and AmoCRM integration."""
 
+import hashlib
 from dataclasses import dataclass, field
+from functools import lru_cache
 from datetime import datetime, date
 from typing import Optional, List, Dict, Any, Union
 from enum import Enum
 
+import orjson
+
 from config import FIELD_MAPPING
 
+# Contact field IDs resolved once at import rather than on every conversion;
+# None marks a field that has no mapping and is skipped
+_CONTACT_FIELD_IDS = {
+    name: FIELD_MAPPING.get(name)
+    for name in (
+        "patient_id", "patient_number", "card_number", "total_visits",
+        "completed_receptions", "advance", "debt", "discount", "status",
+        "age", "gender", "birthdate", "snils", "inn",
+    )
+}
+_PHONE_FIELD_ID = FIELD_MAPPING["phone"]
+_EMAIL_FIELD_ID = FIELD_MAPPING.get("email", 1)
+_COMMENT_FIELD_ID = FIELD_MAPPING.get("comment", 9)
+
+
+@lru_cache(maxsize=4096)
+def normalize_phone(phone: str) -> str:
+    """Normalize phone number for comparison (digits only)."""
+    # Cached: the same numbers are compared over and over within a batch
+    return ''.join(filter(str.isdigit, phone))
+
+
+def payload_hash(payload: Dict[str, Any]) -> bytes:
+    """Fingerprint an AmoCRM payload so unchanged contacts can be skipped."""
+    return hashlib.blake2b(orjson.dumps(payload, option=orjson.OPT_SORT_KEYS), digest_size=16).digest()
+
 
 class Gender(Enum):
     """Patient gender enumeration."""
@@ -116,61 +146,52 @@ class Patient:
     
     def to_amocrm_format(self) -> Dict[str, Any]:
         """Convert patient to AmoCRM contact format."""
+        values = []
         contact_data = {
             "name": self._format_name(),
-            "custom_fields_values": []
+            "custom_fields_values": values
         }
+        person = self.person
         
         # Add phone number
         phone = self._get_primary_phone()
         if phone:
-            contact_data["custom_fields_values"].append({
-                "field_id": FIELD_MAPPING["phone"],
-                "values": [{"value": phone}]
-            })
+            values.append({"field_id": _PHONE_FIELD_ID, "values": [{"value": phone}]})
         
         # Add email
-        if self.person and self.person.email:
-            contact_data["custom_fields_values"].append({
-                "field_id": FIELD_MAPPING.get("email", 1),
-                "values": [{"value": self.person.email}]
-            })
+        if person and person.email:
+            values.append({"field_id": _EMAIL_FIELD_ID, "values": [{"value": person.email}]})
         
         # Add custom fields
+        field_ids = _CONTACT_FIELD_IDS
         custom_fields = [
-            ("patient_id", self.id_patient),
-            ("patient_number", self.patient_number),
-            ("card_number", self.card_number),
-            ("total_visits", self.total_visits),
-            ("completed_receptions", self.completed_receptions_count),
-            ("advance", self.advance),
-            ("debt", self.debt),
-            ("discount", self.discount),
-            ("status", self.status.value),
+            (field_ids["patient_id"], self.id_patient),
+            (field_ids["patient_number"], self.patient_number),
+            (field_ids["card_number"], self.card_number),
+            (field_ids["total_visits"], self.total_visits),
+            (field_ids["completed_receptions"], self.completed_receptions_count),
+            (field_ids["advance"], self.advance),
+            (field_ids["debt"], self.debt),
+            (field_ids["discount"], self.discount),
+            (field_ids["status"], self.status.value),
         ]
         
-        if self.person:
+        if person:
             custom_fields.extend([
-                ("age", self.person.age),
-                ("gender", self.person.sex.value),
-                ("birthdate", self.person.birthday.isoformat() if self.person.birthday else None),
-                ("snils", self.person.snils),
-                ("inn", self.person.inn),
+                (field_ids["age"], person.age),
+                (field_ids["gender"], person.sex.value),
+                (field_ids["birthdate"], person.birthday.isoformat() if person.birthday else None),
+                (field_ids["snils"], person.snils),
+                (field_ids["inn"], person.inn),
             ])
         
-        for field_name, value in custom_fields:
-            if value is not None and field_name in FIELD_MAPPING:
-                contact_data["custom_fields_values"].append({
-                    "field_id": FIELD_MAPPING[field_name],
-                    "values": [{"value": value}]
-                })
+        for field_id, value in custom_fields:
+            if value is not None and field_id is not None:
+                values.append({"field_id": field_id, "values": [{"value": value}]})
         
         # Add comment/notes
         if self.comment:
-            contact_data["custom_fields_values"].append({
-                "field_id": FIELD_MAPPING.get("comment", 9),
-                "values": [{"value": self.comment}]
-            })
+            values.append({"field_id": _COMMENT_FIELD_ID, "values": [{"value": self.comment}]})
         
         return contact_data
 
@@ -1,5 +1,6 @@
 """Reception synchronization module for IDENT to AmoCRM integration."""
 
+from dataclasses import replace
 from datetime import datetime, timedelta
 from typing import List, Dict, Any, Optional
 from loguru import logger
@@ -12,26 +13,93 @@ from src.models import (
     ReceptionStatus
 )
 
+# Reception sync logs its running total once per this many receptions
+PROGRESS_LOG_RECEPTIONS = 100
+
 
 class ReceptionSyncManager:
     """Manages synchronization of receptions between IDENT and AmoCRM."""
     
-    def __init__(self, use_mock: bool = False):
+    def __init__(self, use_mock: bool = False, amocrm: Optional[AmoCRMClient] = None):
         """Initialize reception sync manager."""
         self.db = IdentDatabase()
         
-        if use_mock:
+        if amocrm:
+            self.amocrm = amocrm
+        elif use_mock:
             from src.test_amocrm import MockAmoCRMClient
             self.amocrm = MockAmoCRMClient()
             logger.info("Using Mock AmoCRM Client for reception sync")
         else:
             self.amocrm = AmoCRMClient()
             logger.info("Using Real AmoCRM Client for reception sync")
+        
+        # Per-run caches for AmoCRM search lookups (cleared on every sync run)
+        self._deal_by_reception_cache: Dict[int, Optional[ContactSearchResult]] = {}
+        self._deal_by_patient_number_cache: Dict[str, Optional[ContactSearchResult]] = {}
+        self._contact_by_phone_cache: Dict[str, Optional[ContactSearchResult]] = {}
+    
+    def _clear_search_cache(self):
+        """Drop cached AmoCRM search results."""
+        self._deal_by_reception_cache.clear()
+        self._deal_by_patient_number_cache.clear()
+        self._contact_by_phone_cache.clear()
+    
+    def _invalidate_search_cache(self, reception: Reception):
+        """Forget cached lookups touched by a write for this reception."""
+        self._deal_by_reception_cache.pop(reception.id_reception, None)
+        self._deal_by_patient_number_cache.pop(reception.patient_number, None)
+        self._contact_by_phone_cache.pop(reception.phone, None)
+    
+    def _cache_write_result(self, reception: Reception, search_result: Optional[ContactSearchResult],
+                            result: SyncResult, pipeline_id: int):
+        """Record the contact and deal a successful write left in AmoCRM as the cached lookups."""
+        if search_result and search_result.deal_id:
+            stage_id = search_result.stage_id or AMOCRM_CONFIG["default_stage_id"]
+        else:
+            stage_id = AMOCRM_CONFIG["default_stage_id"]
+        written = ContactSearchResult(
+            contact_id=result.amocrm_contact_id or 0,
+            deal_id=result.amocrm_deal_id,
+            pipeline_id=pipeline_id,
+            stage_id=stage_id
+        )
+        
+        if reception.id_reception:
+            self._deal_by_reception_cache[reception.id_reception] = replace(
+                written, reception_id=reception.id_reception
+            )
+        
+        # The patient-number search only matches deals without a reception ID
+        if reception.patient_number:
+            if not reception.id_reception:
+                self._deal_by_patient_number_cache[reception.patient_number] = replace(
+                    written, patient_number=reception.patient_number
+                )
+            elif self._deal_by_patient_number_cache.get(reception.patient_number) is not None:
+                # The deal it found now carries a reception ID
+                self._deal_by_patient_number_cache.pop(reception.patient_number, None)
+        
+        if reception.phone:
+            if result.amocrm_contact_id:
+                self._contact_by_phone_cache[reception.phone] = replace(written, phone=reception.phone)
+            else:
+                self._contact_by_phone_cache.pop(reception.phone, None)
+    
+    def _cached_lookup(self, cache: Dict[Any, Optional[ContactSearchResult]], key: Any,
+                       lookup) -> Optional[ContactSearchResult]:
+        """Return cached search result for key, calling lookup on a miss."""
+        if key in cache:
+            return cache[key]
+        result = lookup(key)
+        cache[key] = result
+        return result
     
     def sync_receptions(self, since: Optional[datetime] = None) -> List[SyncResult]:
         """Synchronize receptions from IDENT to AmoCRM."""
         logger.info("Starting reception synchronization")
         results = []
+        self._clear_search_cache()
         
         try:
             with self.db as db:
@@ -45,7 +113,7 @@ class ReceptionSyncManager:
                         results.append(result)
                         
                         # Log progress
-                        if len(results) % 10 == 0:
+                        if len(results) % PROGRESS_LOG_RECEPTIONS == 0:
                             logger.info(f"Processed {len(results)} receptions")
                             
                     except Exception as e:
@@ -91,12 +159,25 @@ class ReceptionSyncManager:
             pipeline_id = self._get_pipeline_id(funnel_type)
             
             # Step 4: Create or update contact and deal
-            if search_result:
-                # Found existing deal or contact
-                return self._update_existing_deal(reception, patient, search_result, pipeline_id)
+            try:
+                if search_result:
+                    # Found existing deal or contact
+                    result = self._update_existing_deal(reception, patient, search_result, pipeline_id)
+                else:
+                    # Create new contact and deal
+                    result = self._create_new_deal(reception, patient, pipeline_id)
+            except Exception:
+                self._invalidate_search_cache(reception)
+                raise
+            
+            if result.success:
+                # Later receptions of this patient can reuse what was just written
+                self._cache_write_result(reception, search_result, result, pipeline_id)
             else:
-                # Create new contact and deal
-                return self._create_new_deal(reception, patient, pipeline_id)
+                # AmoCRM state may have changed even if a later step failed (a
+                # contact created before its deal), so cached lookups are stale
+                self._invalidate_search_cache(reception)
+            return result
                 
         except Exception as e:
             logger.error(f"Error syncing reception {reception.id_reception}: {e}")
@@ -113,21 +194,30 @@ class ReceptionSyncManager:
         
         # 1. Search by ID Приёма (highest priority)
         if "reception_id" in search_keys:
-            result = self.amocrm.find_deal_by_reception_id(search_keys["reception_id"])
+            result = self._cached_lookup(
+                self._deal_by_reception_cache, search_keys["reception_id"],
+                self.amocrm.find_deal_by_reception_id
+            )
             if result:
                 logger.debug(f"Found deal by reception ID: {search_keys['reception_id']}")
                 return result
         
         # 2. Search by порядковый номер в МИС (medium priority)
         if "patient_number" in search_keys:
-            result = self.amocrm.find_deal_by_patient_number(search_keys["patient_number"])
+            result = self._cached_lookup(
+                self._deal_by_patient_number_cache, search_keys["patient_number"],
+                self.amocrm.find_deal_by_patient_number
+            )
             if result:
                 logger.debug(f"Found deal by patient number: {search_keys['patient_number']}")
                 return result
         
         # 3. Search by номер телефона (lowest priority)
         if "phone" in search_keys:
-            result = self.amocrm.find_contact_by_phone(search_keys["phone"])
+            result = self._cached_lookup(
+                self._contact_by_phone_cache, search_keys["phone"],
+                self.amocrm.find_contact_by_phone
+            )
             if result:
                 logger.debug(f"Found contact by phone: {search_keys['phone']}")
                 return result
@@ -138,84 +228,7 @@ class ReceptionSyncManager:
     def _get_patient_data(self, patient_id: int, db: IdentDatabase) -> Optional[Patient]:
         """Get patient data from database."""
         try:
-            query = """
-            SELECT 
-                p.ID_Patients,
-                p.ID_Persons,
-                p.FirstVisit,
-                p.CardNumber,
-                p.Comment,
-                p.PatientNumber,
-                p.Status,
-                p.ID_ArchiveReasons,
-                p.ID_Branches,
-                p.DateTimeChanged,
-                per.Surname,
-                per.Name,
-                per.Patronymic,
-                per.Sex,
-                per.Birthday,
-                per.Phone,
-                per.MobilePhone,
-                per.Email,
-                per.City,
-                per.INN,
-                per.SNILS,
-                per.Passport,
-                per.Age
-            FROM Patients p
-            LEFT JOIN Persons per ON p.ID_Persons = per.ID
-            WHERE p.ID_Patients = ?
-            """
-            
-            db._cursor.execute(query, patient_id)
-            row = db._cursor.fetchone()
-            
-            if not row:
-                return None
-            
-            # Create patient object manually
-            from src.models import Person, PatientStatus, Gender
-            
-            person = Person(
-                id=row.ID_Persons,
-                surname=row.Surname or "",
-                name=row.Name or "",
-                patronymic=row.Patronymic,
-                sex=Gender(row.Sex or 0),
-                birthday=row.Birthday,
-                phone=row.Phone,
-                mobile_phone=row.MobilePhone,
-                email=row.Email,
-                city=row.City,
-                inn=row.INN,
-                snils=row.SNILS,
-                passport=row.Passport,
-                age=row.Age,
-                date_time_changed=getattr(row, 'DateTimeChanged', None)
-            )
-            
-            patient = Patient(
-                id_patient=row.ID_Patients,
-                id_persons=row.ID_Persons,
-                first_visit=row.FirstVisit,
-                card_number=row.CardNumber,
-                comment=row.Comment,
-                patient_number=row.PatientNumber,
-                status=PatientStatus(row.Status or 1),
-                archive_reason=db._get_archive_reason(getattr(row, 'ID_ArchiveReasons', None)),
-                branch=db._get_branch_name(getattr(row, 'ID_Branches', None)),
-                person=person,
-                last_updated=getattr(row, 'DateTimeChanged', None)
-            )
-            
-            # Get additional calculated fields
-            patient.discount = db._get_patient_discount(row.ID_Patients)
-            patient.total_visits = db._get_patient_visits_count(row.ID_Patients)
-            patient.advance, patient.debt = db._get_patient_balance(row.ID_Patients)
-            patient.completed_receptions_count = db.get_patient_completed_receptions_count(row.ID_Patients)
-            
-            return patient
+            return db.get_patient(patient_id)
             
         except Exception as e:
             logger.error(f"Failed to get patient data for {patient_id}: {e}")
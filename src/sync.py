@@ -2,8 +2,12 @@
 
 import time
 import os
+import queue
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime, timedelta
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional, Tuple
 import schedule
 from loguru import logger
 import pytz
@@ -12,9 +16,32 @@ from config import sync_config, app_config
 from src.database import IdentDatabase
 from src.amocrm import AmoCRMClient
 from src.test_amocrm import MockAmoCRMClient
-from src.models import Patient
+from src.models import Patient, payload_hash
 from src.reception_sync import ReceptionSyncManager
 
+# SyncCursor row holding the incremental patient sync high-water mark
+PATIENT_SYNC_CURSOR = "patients"
+
+# Changed patients fetched per keyset query; pages are uploaded in
+# batch_size slices, so this only sets how often the change index is sought
+CHANGED_PATIENTS_PAGE_SIZE = 2000
+
+# Batches the full sync loader may read ahead of the AmoCRM uploader
+PIPELINE_QUEUE_SIZE = 4
+
+# Longest the scheduler loop sleeps between checks for due jobs
+MAX_IDLE_SLEEP_SECONDS = 60
+
+# Shortest sleep, so a job whose next run was not pushed forward can't spin the loop
+MIN_IDLE_SLEEP_SECONDS = 0.5
+
+# Full sync logs its running total once per this many batches
+PROGRESS_LOG_BATCHES = 10
+
+# Failed patients are retried with backoff until this many attempts, then
+# left in SyncState as failed for manual inspection
+MAX_SYNC_ATTEMPTS = 10
+
 
 class SyncManager:
     """Manages synchronization between IDENT and AmoCRM."""
@@ -26,21 +53,32 @@ class SyncManager:
         # Use mock client for testing
         if use_mock or os.getenv('USE_MOCK_AMOCRM', 'false').lower() == 'true':
             self.amocrm = MockAmoCRMClient()
+            shared_client = None
             logger.info("Using Mock AmoCRM Client for testing")
         else:
             self.amocrm = AmoCRMClient()
+            shared_client = self.amocrm
             logger.info("Using Real AmoCRM Client")
             
-        # Initialize reception sync manager
-        self.reception_sync = ReceptionSyncManager(use_mock)
+        # Initialize reception sync manager; the real client is shared so both
+        # managers reuse one connection pool and stay under one rate limit
+        self.reception_sync = ReceptionSyncManager(use_mock, amocrm=shared_client)
             
         self.timezone = pytz.timezone(app_config.timezone)
         self.batch_size = sync_config.batch_size
+        # Batch uploads the full sync keeps in flight at once
+        self.upload_concurrency = max(1, sync_config.upload_concurrency)
         
         # Track sync state
         self.last_incremental_sync = None
         self.last_reception_sync = None
         self.initial_sync_completed = False
+        
+        # Set by stop() to wake the scheduler loop immediately
+        self._stop_event = threading.Event()
+        
+        # patient_id -> (contact_id, hash of the last payload sent), loaded by each full pass
+        self._payload_hashes: Dict[int, Tuple[int, bytes]] = {}
     
     def run(self):
         """Run the synchronization service."""
@@ -58,30 +96,51 @@ class SyncManager:
         # Schedule reception syncs (more frequent)
         schedule.every(1).minutes.do(self.incremental_reception_sync)
         
-        # Schedule deep syncs
-        schedule.every().day.at(f"{sync_config.deep_sync_hour_morning:02d}:00").do(self.deep_sync)
-        schedule.every().day.at(f"{sync_config.deep_sync_hour_evening:02d}:00").do(self.deep_sync)
+        # Schedule deep syncs in the configured timezone rather than host
+        # local time, so DST shifts neither skip nor double-fire them
+        deep_sync_slots = {
+            sync_config.deep_sync_hour_evening: "evening",
+            sync_config.deep_sync_hour_morning: "morning",
+        }
+        for hour, slot in sorted(deep_sync_slots.items()):
+            schedule.every().day.at(f"{hour:02d}:00", self.timezone).do(self.deep_sync, slot=slot)
         
         logger.info(f"Scheduled patient sync every {sync_config.interval_minutes} minutes")
         logger.info(f"Scheduled reception sync every 1 minute")
-        logger.info(f"Scheduled deep sync at {sync_config.deep_sync_hour_morning}:00 and {sync_config.deep_sync_hour_evening}:00")
+        logger.info(f"Scheduled deep sync at {sync_config.deep_sync_hour_morning}:00 and {sync_config.deep_sync_hour_evening}:00 {self.timezone}")
         
-        # Run the scheduler
-        while True:
+        # Run the scheduler, waiting until the next job is due or stop() is called
+        while not self._stop_event.is_set():
             try:
                 schedule.run_pending()
-                time.sleep(1)
+                
+                idle_seconds = schedule.idle_seconds()
+                if idle_seconds is None:
+                    logger.warning("No scheduled jobs left, stopping synchronization service")
+                    break
+                # Capped so wall-clock jumps are picked up within a minute; all due
+                # jobs just ran, so a non-positive value here means a stuck next_run
+                self._stop_event.wait(
+                    max(MIN_IDLE_SLEEP_SECONDS, min(idle_seconds, MAX_IDLE_SLEEP_SECONDS))
+                )
             except KeyboardInterrupt:
                 logger.info("Synchronization service stopped by user")
                 break
             except Exception as e:
                 logger.error(f"Unexpected error in sync loop: {e}")
-                time.sleep(60)  # Wait before retrying
+                self._stop_event.wait(60)  # Wait before retrying
+        
+        schedule.clear()
+        logger.info("Synchronization service stopped")
+    
+    def stop(self):
+        """Ask the scheduler loop to exit, ending a running full patient sync early."""
+        self._stop_event.set()
     
     def full_sync(self):
         """Perform full synchronization of all patients and receptions."""
         logger.info("Starting full synchronization")
-        start_time = datetime.now()
+        started = time.monotonic()
         
         try:
             # Sync patients first
@@ -90,8 +149,7 @@ class SyncManager:
             # Then sync receptions
             self._full_reception_sync()
             
-            duration = datetime.now() - start_time
-            logger.info(f"Full synchronization completed in {duration}")
+            logger.info(f"Full synchronization completed in {time.monotonic() - started:.2f}s")
             
             # Log mock statistics if using mock client
             if hasattr(self.amocrm, 'get_stats'):
@@ -106,22 +164,83 @@ class SyncManager:
         """Perform full patient synchronization."""
         logger.info("Starting full patient synchronization")
         
-        with self.db as db:
-            # Get sync state
-            sync_state = db.get_sync_state()
+        # Loader thread streams batches from the DB while this thread uploads
+        # them, so SQL and HTTP round-trips overlap. The loader owns self.db;
+        # sync state is written through a second connection, in batch order,
+        # as uploads complete.
+        batches = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+        stop = threading.Event()
+        in_flight = deque()
+        
+        with self.db as db, IdentDatabase() as writer, \
+                ThreadPoolExecutor(max_workers=self.upload_concurrency, thread_name_prefix="amocrm-upload") as uploads:
+            # Payload hashes are all a full pass consults to skip unchanged patients
+            self._payload_hashes = db.get_payload_hashes()
+            
+            # A full scan touches nearly every archive reason and branch, so
+            # fetch those small tables whole instead of one ID at a time
+            db.load_dimensions()
             
-            # Get all patients
-            patients = db.get_all_patients()
-            logger.info(f"Found {len(patients)} patients to sync")
+            loader = threading.Thread(
+                target=self._load_patient_batches,
+                args=(db, batches, stop),
+                name="patient-loader",
+                daemon=True
+            )
+            loader.start()
+            processed = 0
+            batch_count = 0
+            batch = []
             
-            # Process in batches
-            for i in range(0, len(patients), self.batch_size):
-                batch = patients[i:i + self.batch_size]
-                self._process_patient_batch(batch, sync_state, db)
+            try:
+                while True:
+                    batch = batches.get()
+                    if batch is None:
+                        break
+                    if isinstance(batch, Exception):
+                        raise batch
+                    
+                    prepared, contacts_data, unchanged, invalid = self._prepare_patient_batch(batch)
+                    self._mark_synced(unchanged, writer)
+                    writer.bulk_record_sync_failures(invalid)
+                    if contacts_data:
+                        future = uploads.submit(self.amocrm.batch_create_or_update_contacts, contacts_data)
+                        in_flight.append((prepared, future))
+                    
+                    # Wait for the oldest upload once the window is full
+                    while len(in_flight) >= self.upload_concurrency:
+                        self._finish_upload(*in_flight.popleft(), writer)
+                    
+                    # Log progress
+                    processed += len(batch)
+                    batch_count += 1
+                    if batch_count % PROGRESS_LOG_BATCHES == 0:
+                        logger.info(f"Processed {processed} patients")
                 
-                # Log progress
-                progress = min(i + self.batch_size, len(patients))
-                logger.info(f"Processed {progress}/{len(patients)} patients")
+                while in_flight:
+                    self._finish_upload(*in_flight.popleft(), writer)
+            finally:
+                # Unblock the loader if we bailed out early, then wait for it
+                stop.set()
+                while batch is not None:
+                    batch = batches.get()
+                loader.join()
+            
+            logger.info(f"Full patient synchronization processed {processed} patients")
+    
+    def _load_patient_batches(self, db: IdentDatabase, batches: queue.Queue, stop: threading.Event):
+        """Stream patient batches into the queue, ending with None."""
+        try:
+            for batch in db.iter_patient_batches(self.batch_size):
+                # stop() ends a running full sync after the batches already queued
+                if stop.is_set() or self._stop_event.is_set():
+                    break
+                batches.put(batch)
+        except Exception as e:
+            logger.error(f"Failed to load patients: {e}")
+            batches.put(e)
+        finally:
+            batches.put(None)
     
     def _full_reception_sync(self):
         """Perform full reception synchronization."""
@@ -142,36 +261,79 @@ class SyncManager:
         """Perform incremental synchronization of changed patient records."""
         logger.info("Starting incremental patient synchronization")
         start_time = datetime.now()
+        started = time.monotonic()
         
         try:
-            # Determine the time range for changes
-            if self.last_incremental_sync:
-                since = self.last_incremental_sync
-            else:
-                # Default to last 24 hours for first incremental sync
-                since = datetime.now() - timedelta(hours=24)
-            
             with self.db as db:
-                # Get sync state
-                sync_state = db.get_sync_state()
+                # Resume from the persisted keyset position
+                position = db.get_sync_cursor(PATIENT_SYNC_CURSOR)
+                if position:
+                    after_changed, after_id = position
+                else:
+                    # Default to last 24 hours for first incremental sync
+                    after_changed, after_id = datetime.now() - timedelta(hours=24), 0
                 
-                # Get changed patients
-                patients = db.get_changed_patients(since)
-                logger.info(f"Found {len(patients)} changed patients since {since}")
+                processed = 0
                 
-                if patients:
-                    # Process in batches
-                    for i in range(0, len(patients), self.batch_size):
-                        batch = patients[i:i + self.batch_size]
-                        self._process_patient_batch(batch, sync_state, db)
+                # Page through changed patients until the keyset stops advancing;
+                # each page carries its own sync state, so the full table isn't read
+                while True:
+                    page, sync_state, payload_hashes = db.get_changed_patients_page(
+                        after_changed, after_id, CHANGED_PATIENTS_PAGE_SIZE
+                    )
+                    if not page:
+                        break
+                    self._payload_hashes.update(payload_hashes)
+                    
+                    for start in range(0, len(page), self.batch_size):
+                        batch = page[start:start + self.batch_size]
+                        last = batch[-1]
+                        
+                        # Sync state and cursor advance land in one commit, so a
+                        # failed write never moves the cursor past unsynced patients
+                        with db.transaction():
+                            self._process_patient_batch(batch, sync_state, db)
+                            db.update_sync_cursor(PATIENT_SYNC_CURSOR, last.last_updated, last.id_patient)
+                        
+                        processed += len(batch)
+                        after_changed, after_id = last.last_updated, last.id_patient
+                    
+                    # A short page means the keyset has reached the newest change
+                    if len(page) < CHANGED_PATIENTS_PAGE_SIZE:
+                        break
+                
+                logger.info(f"Found {processed} changed patients, synced up to {after_changed}")
+                
+                # Patients due for retry have no successful sync state to consult
+                self._retry_failed_patients(db, {})
             
             self.last_incremental_sync = start_time
-            duration = datetime.now() - start_time
-            logger.info(f"Incremental patient synchronization completed in {duration}")
+            logger.info(f"Incremental patient synchronization completed in {time.monotonic() - started:.2f}s")
             
         except Exception as e:
+            # A rolled-back page may have left its hashes in memory
+            self._payload_hashes = {}
             logger.error(f"Incremental patient sync failed: {e}")
     
+    def _retry_failed_patients(self, db: IdentDatabase, sync_state: Dict[int, datetime]):
+        """Resubmit patients whose earlier sync failed and whose backoff has elapsed."""
+        patient_ids = db.get_patients_due_for_retry(MAX_SYNC_ATTEMPTS, self.batch_size)
+        if not patient_ids:
+            return
+        
+        logger.info(f"Retrying {len(patient_ids)} previously failed patients")
+        patients = db.get_patients(patient_ids)
+        
+        # Deleted or vanished patients still count as an attempt, so they move
+        # to the back of the retry queue and drop out after MAX_SYNC_ATTEMPTS
+        found = {patient.id_patient for patient in patients}
+        missing = [(patient_id, "Patient not found") for patient_id in patient_ids if patient_id not in found]
+        if missing:
+            logger.warning(f"{len(missing)} patients due for retry no longer exist")
+            db.bulk_record_sync_failures(missing)
+        
+        self._process_patient_batch(patients, sync_state, db)
+    
     def incremental_reception_sync(self):
         """Perform incremental synchronization of reception changes."""
         try:
@@ -184,6 +346,13 @@ class SyncManager:
             
             start_time = datetime.now()
             
+            # Skip the full reception pass when nothing changed since the last run
+            with self.db as db:
+                if not db.has_reception_changes(since):
+                    logger.debug(f"No reception changes since {since}")
+                    self.last_reception_sync = start_time
+                    return
+            
             results = self.reception_sync.sync_receptions(since)
             
             if results:
@@ -196,77 +365,169 @@ class SyncManager:
         except Exception as e:
             logger.error(f"Incremental reception sync failed: {e}")
     
-    def deep_sync(self):
+    def deep_sync(self, slot: Optional[str] = None):
         """Perform deep synchronization (similar to full sync but scheduled)."""
         logger.info("Starting deep synchronization")
-        current_time = datetime.now(self.timezone)
+        started = time.monotonic()
         
-        # Log which deep sync this is
-        if current_time.hour < 12:
-            logger.info("Running morning deep sync")
-        else:
-            logger.info("Running evening deep sync")
+        # Log which deep sync this is, as registered with the scheduler
+        if slot:
+            logger.info(f"Running {slot} deep sync")
         
-        # Run full sync
-        self.full_sync()
+        # Every patient is scanned, since visit, payment and discount totals
+        # change without touching Patients/Persons; the payload hash keeps
+        # unchanged contacts from being uploaded again
+        try:
+            self._full_patient_sync()
+            self._full_reception_sync()
+            
+            logger.info(f"Deep synchronization completed in {time.monotonic() - started:.2f}s")
+        except Exception as e:
+            logger.error(f"Deep sync failed: {e}")
+            raise
     
-    def _process_patient_batch(self, patients: List[Patient], sync_state: Dict[int, Dict[str, Any]], db: IdentDatabase):
+    def _process_patient_batch(self, patients: List[Patient], sync_state: Dict[int, datetime], db: IdentDatabase):
         """Process a batch of patients."""
-        # Convert patients to AmoCRM format
+        # Incremental pages are selected by Patients/Persons change time, so a
+        # patient synced after that change has nothing new to send
+        pending = [p for p in patients if not self._is_up_to_date(p, sync_state)]
+        if len(pending) < len(patients):
+            logger.debug(f"Skipping {len(patients) - len(pending)} up-to-date patients")
+        patients = pending
+        
+        prepared, contacts_data, unchanged, invalid = self._prepare_patient_batch(patients)
+        self._mark_synced(unchanged, db)
+        db.bulk_record_sync_failures(invalid)
+        if not contacts_data:
+            return
+        
+        # Send to AmoCRM (real or mock)
+        try:
+            results = self.amocrm.batch_create_or_update_contacts(contacts_data)
+        except Exception as e:
+            logger.error(f"Failed to process batch: {e}")
+            self._record_batch_failure(prepared, e, db)
+            return
+        
+        self._record_batch_results(prepared, results, db)
+    
+    def _finish_upload(self, prepared: List[Tuple[Patient, bytes]], upload: Future, db: IdentDatabase):
+        """Wait for a submitted batch upload and record its outcome."""
+        try:
+            results = upload.result()
+        except Exception as e:
+            logger.error(f"Failed to process batch: {e}")
+            self._record_batch_failure(prepared, e, db)
+            return
+        
+        self._record_batch_results(prepared, results, db)
+    
+    def _prepare_patient_batch(self, patients: List[Patient]) -> Tuple[
+            List[Tuple[Patient, bytes]], List[Dict[str, Any]],
+            List[Tuple[Patient, int, bytes]], List[Tuple[int, str]]]:
+        """Convert patients to AmoCRM contacts, setting aside those whose payload is unchanged."""
+        # Returns (patient, hash) pairs aligned with the contacts to send, and
+        # (patient, contact_id, hash) for patients whose last sent payload matches,
+        # and (patient_id, error) for patients that could not be converted.
+        # No change-time filter here: visit, payment and discount totals come from
+        # other tables, so only the payload hash can tell a full pass what changed
+        if not patients:
+            return [], [], [], []
+        
+        # Convert patients to AmoCRM format, keeping patients aligned with payloads
         contacts_data = []
-        patient_map = {}
+        prepared = []
+        unchanged = []
+        invalid = []
         
         for patient in patients:
             try:
                 amocrm_data = patient.to_amocrm_format()
-                contacts_data.append(amocrm_data)
+                digest = payload_hash(amocrm_data)
                 
-                # Store mapping for later
-                patient_id = patient.id_patient
-                patient_map[patient_id] = amocrm_data
+                # A change to fields AmoCRM doesn't receive leaves the payload as it was
+                last_sent = self._payload_hashes.get(patient.id_patient)
+                if last_sent is not None and last_sent[1] == digest:
+                    unchanged.append((patient, last_sent[0], digest))
+                    continue
                 
-                logger.debug(f"Prepared patient {patient_id} for sync: {patient._format_name()}")
+                contacts_data.append(amocrm_data)
+                prepared.append((patient, digest))
+                
+                # Lazy: the name is only formatted when debug logging is enabled
+                logger.opt(lazy=True).debug("Prepared patient {} for sync: {}",
+                                            lambda: patient.id_patient, patient._format_name)
                 
             except Exception as e:
                 logger.error(f"Failed to prepare patient {patient.id_patient}: {e}")
+                invalid.append((patient.id_patient, f"Failed to prepare patient: {e}"))
         
-        if not contacts_data:
+        if unchanged:
+            logger.debug(f"Skipping {len(unchanged)} patients with an unchanged payload")
+        if not contacts_data and not unchanged:
             logger.warning("No valid contacts to sync in this batch")
+        
+        return prepared, contacts_data, unchanged, invalid
+    
+    def _record_batch_results(self, prepared: List[Tuple[Patient, bytes]], results: Dict[str, List],
+                              db: IdentDatabase):
+        """Write sync state for an uploaded batch and queue its failures for retry."""
+        # results['ids'] is aligned with the submitted contacts, so one pass
+        # pairs every contact ID with the patient it belongs to
+        synced = []
+        failed = []
+        for (patient, digest), contact_id in zip(prepared, results['ids']):
+            if contact_id is None:
+                failed.append((patient.id_patient, "AmoCRM create/update failed"))
+                self._payload_hashes.pop(patient.id_patient, None)
+            else:
+                synced.append((patient, contact_id, digest))
+        
+        # Update sync state for successful syncs in a single round-trip; inside
+        # db.transaction() a failure here propagates so the caller rolls back
+        self._mark_synced(synced, db)
+        
+        # Log results
+        logger.info(f"Batch results - Created: {len(results['created'])}, "
+                   f"Updated: {len(results['updated'])}, Failed: {len(failed)}")
+        
+        # Handle failures: queue them for a backed-off retry by incremental sync
+        if failed:
+            logger.warning(f"Failed to sync {len(failed)} contacts")
+            db.bulk_record_sync_failures(failed)
+    
+    def _mark_synced(self, synced: List[Tuple[Patient, int, bytes]], db: IdentDatabase):
+        """Write success state for (patient, contact_id, payload hash) rows and remember their hashes."""
+        if not synced:
             return
         
-        # Send to AmoCRM (real or mock)
-        try:
-            results = self.amocrm.batch_create_or_update_contacts(contacts_data)
-            
-            # Update sync state for successful syncs
-            for contact_id in results['created'] + results['updated']:
-                # Find the patient ID for this contact (simplified mapping)
-                for patient_id in patient_map.keys():
-                    try:
-                        db.update_sync_state(patient_id, contact_id, 'success')
-                        break
-                    except Exception as e:
-                        logger.error(f"Failed to update sync state for patient {patient_id}: {e}")
-            
-            # Log results
-            logger.info(f"Batch results - Created: {len(results['created'])}, "
-                       f"Updated: {len(results['updated'])}, Failed: {len(results['failed'])}")
-            
-            # Handle failures
-            if results['failed']:
-                logger.warning(f"Failed to sync {len(results['failed'])} contacts")
-                # Could implement retry logic here
-                
-        except Exception as e:
-            logger.error(f"Failed to process batch: {e}")
+        rows = [(patient.id_patient, contact_id, 'success', digest) for patient, contact_id, digest in synced]
+        if db.bulk_update_sync_state(rows):
+            # Keep the in-memory hashes current instead of re-reading them
+            for patient, contact_id, digest in synced:
+                self._payload_hashes[patient.id_patient] = (contact_id, digest)
+    
+    def _record_batch_failure(self, prepared: List[Tuple[Patient, bytes]], error: Exception,
+                              db: IdentDatabase):
+        """Queue every patient of a batch that failed as a whole for retry."""
+        for patient, _ in prepared:
+            self._payload_hashes.pop(patient.id_patient, None)
+        db.bulk_record_sync_failures([(patient.id_patient, str(error)) for patient, _ in prepared])
+    
+    @staticmethod
+    def _is_up_to_date(patient: Patient, sync_state: Dict[int, datetime]) -> bool:
+        """Check if patient was synced after its last change."""
+        last_sync = sync_state.get(patient.id_patient)
+        if last_sync is None or patient.last_updated is None:
+            return False
+        return patient.last_updated <= last_sync
     
     def _check_initial_sync_status(self) -> bool:
         """Check if initial sync has been completed."""
         try:
             with self.db as db:
-                sync_state = db.get_sync_state()
                 # If we have any sync state, assume initial sync is done
-                return len(sync_state) > 0
+                return db.has_any_sync_state()
         except Exception as e:
             logger.error(f"Failed to check initial sync status: {e}")
             return False
@@ -278,95 +539,23 @@ class SyncManager:
         try:
             with self.db as db:
                 # Get specific patient by ID
-                query = """
-                SELECT 
-                    p.ID_Patients,
-                    p.ID_Persons,
-                    p.FirstVisit,
-                    p.CardNumber,
-                    p.Comment,
-                    p.PatientNumber,
-                    p.Status,
-                    p.ID_ArchiveReasons,
-                    p.ID_Branches,
-                    p.DateTimeChanged,
-                    per.Surname,
-                    per.Name,
-                    per.Patronymic,
-                    per.Sex,
-                    per.Birthday,
-                    per.Phone,
-                    per.MobilePhone,
-                    per.Email,
-                    per.City,
-                    per.INN,
-                    per.SNILS,
-                    per.Passport,
-                    per.Age
-                FROM Patients p
-                LEFT JOIN Persons per ON p.ID_Persons = per.ID
-                WHERE p.ID_Patients = ?
-                """
-                
-                db._cursor.execute(query, patient_id)
-                row = db._cursor.fetchone()
+                patient = db.get_patient(patient_id)
                 
-                if not row:
+                if not patient:
                     logger.error(f"Patient {patient_id} not found")
                     return False
                 
-                # Create Patient object
-                from src.models import Person, PatientStatus, Gender
-                
-                person = Person(
-                    id=row.ID_Persons,
-                    surname=row.Surname or "",
-                    name=row.Name or "",
-                    patronymic=row.Patronymic,
-                    sex=Gender(row.Sex or 0),
-                    birthday=row.Birthday,
-                    phone=row.Phone,
-                    mobile_phone=row.MobilePhone,
-                    email=row.Email,
-                    city=row.City,
-                    inn=row.INN,
-                    snils=row.SNILS,
-                    passport=row.Passport,
-                    age=row.Age,
-                    date_time_changed=row.DateTimeChanged
-                )
-                
-                patient = Patient(
-                    id_patient=row.ID_Patients,
-                    id_persons=row.ID_Persons,
-                    first_visit=row.FirstVisit,
-                    card_number=row.CardNumber,
-                    comment=row.Comment,
-                    patient_number=row.PatientNumber,
-                    status=PatientStatus(row.Status or 1),
-                    archive_reason=db._get_archive_reason(row.ID_ArchiveReasons),
-                    branch=db._get_branch_name(row.ID_Branches),
-                    person=person,
-                    last_updated=row.DateTimeChanged
-                )
-                
-                # Get additional patient data
-                patient.discount = db._get_patient_discount(row.ID_Patients)
-                patient.total_visits = db._get_patient_visits_count(row.ID_Patients)
-                patient.advance, patient.debt = db._get_patient_balance(row.ID_Patients)
-                patient.completed_receptions_count = db.get_patient_completed_receptions_count(row.ID_Patients)
-                
                 # Convert to AmoCRM format
                 amocrm_data = patient.to_amocrm_format()
                 logger.info(f"Patient data: {patient._format_name()}")
-                logger.debug(f"AmoCRM data: {amocrm_data}")
+                logger.opt(lazy=True).debug("AmoCRM data: {}", lambda: amocrm_data)
                 
                 # Send to AmoCRM
                 contact_id = self.amocrm.create_or_update_contact(amocrm_data)
                 
                 if contact_id:
                     # Update sync state
-                    db.update_sync_state(patient_id, contact_id, 'success')
+                    db.update_sync_state(patient_id, contact_id, 'success', payload_hash(amocrm_data))
                     logger.info(f"Successfully synced patient {patient_id} to contact {contact_id}")
                     
                     # Log mock statistics if using mock client
@@ -416,15 +605,11 @@ class SyncManager:
             reception_stats = self.reception_sync.get_sync_statistics()
             stats.update(reception_stats)
             
-            # Get patient statistics
+            # Get patient statistics, counted by the database
             with self.db as db:
-                patients = db.get_all_patients()
-                stats["total_patients"] = len(patients)
-                
-                # Count funnel distribution
-                primary_count = sum(1 for p in patients if p.completed_receptions_count == 0)
-                secondary_count = len(patients) - primary_count
+                primary_count, secondary_count = db.get_funnel_counts()
                 
+                stats["total_patients"] = primary_count + secondary_count
                 stats["primary_funnel_patients"] = primary_count
                 stats["secondary_funnel_patients"] = secondary_count
                 
@@ -2,9 +2,12 @@
 
 import json
 import time
-from typing import Dict, Any, Optional, List
+import threading
+from typing import Dict, Any, Optional, List, Set, Tuple
 from loguru import logger
 
+from src.models import normalize_phone
+
 
 class MockAmoCRMClient:
     """Mock AmoCRM client that simulates API responses without making real calls."""
@@ -21,9 +24,21 @@ class MockAmoCRMClient:
         self.mock_contacts = {}
         self.next_contact_id = 1000
         
+        # Mock database of deals
+        self.mock_deals = {}
+        self.next_deal_id = 5000
+        
+        # Secondary indexes so lookups don't scan every contact
+        self._phone_index: Dict[str, Set[int]] = {}
+        self._field_index: Dict[Tuple[int, str], Set[int]] = {}
+        self._index_keys: Dict[int, List[Tuple[Dict, Any]]] = {}
+        
         # Track API calls for testing
         self.api_calls = []
         
+        # Batches may be submitted from several upload threads
+        self._batch_lock = threading.Lock()
+        
         logger.info("Initialized Mock AmoCRM Client")
     
     def _log_api_call(self, method: str, endpoint: str, data: Any = None):
@@ -37,38 +52,52 @@ class MockAmoCRMClient:
         self.api_calls.append(call)
         logger.debug(f"Mock API Call: {method} {endpoint}")
     
+    def _index_contact(self, contact: Dict[str, Any]):
+        """Add a contact's custom field values to the lookup indexes."""
+        keys = []
+        for field in contact.get('custom_fields_values', []):
+            field_id = field.get('field_id')
+            for field_value in field.get('values', []):
+                value = field_value.get('value', '')
+                keys.append((self._field_index, (field_id, str(value))))
+                if field_id == 2:  # Phone field
+                    keys.append((self._phone_index, self._normalize_phone(value)))
+        
+        for index, key in keys:
+            index.setdefault(key, set()).add(contact['id'])
+        self._index_keys[contact['id']] = keys
+    
+    def _unindex_contact(self, contact_id: int):
+        """Remove a contact from the lookup indexes."""
+        for index, key in self._index_keys.pop(contact_id, []):
+            contact_ids = index[key]
+            contact_ids.discard(contact_id)
+            if not contact_ids:
+                del index[key]
+    
     def get_contact_by_phone(self, phone: str) -> Optional[Dict[str, Any]]:
         """Mock: Find contact by phone number."""
         self._log_api_call('GET', 'contacts', {'query': phone})
         
-        normalized_phone = self._normalize_phone(phone)
-        
-        for contact in self.mock_contacts.values():
-            custom_fields = contact.get('custom_fields_values', [])
-            for field in custom_fields:
-                if field.get('field_id') == 2:  # Phone field
-                    for value in field.get('values', []):
-                        if self._normalize_phone(value.get('value', '')) == normalized_phone:
-                            logger.info(f"Mock: Found contact by phone {phone}")
-                            return contact
+        contact_ids = self._phone_index.get(self._normalize_phone(phone))
+        if contact_ids:
+            logger.debug(f"Mock: Found contact by phone {phone}")
+            # Lowest ID is the earliest created, matching a scan in insertion order
+            return self.mock_contacts[min(contact_ids)]
         
-        logger.info(f"Mock: No contact found for phone {phone}")
+        logger.debug(f"Mock: No contact found for phone {phone}")
         return None
     
     def get_contact_by_custom_field(self, field_id: int, value: str) -> Optional[Dict[str, Any]]:
         """Mock: Find contact by custom field value."""
         self._log_api_call('GET', 'contacts', {'query': value})
         
-        for contact in self.mock_contacts.values():
-            custom_fields = contact.get('custom_fields_values', [])
-            for field in custom_fields:
-                if field.get('field_id') == field_id:
-                    for field_value in field.get('values', []):
-                        if str(field_value.get('value', '')) == str(value):
-                            logger.info(f"Mock: Found contact by field {field_id} = {value}")
-                            return contact
+        contact_ids = self._field_index.get((field_id, str(value)))
+        if contact_ids:
+            logger.debug(f"Mock: Found contact by field {field_id} = {value}")
+            return self.mock_contacts[min(contact_ids)]
         
-        logger.info(f"Mock: No contact found for field {field_id} = {value}")
+        logger.debug(f"Mock: No contact found for field {field_id} = {value}")
         return None
     
     def create_contact(self, contact_data: Dict[str, Any]) -> Optional[int]:
@@ -88,8 +117,9 @@ class MockAmoCRMClient:
         }
         
         self.mock_contacts[contact_id] = mock_contact
+        self._index_contact(mock_contact)
         
-        logger.info(f"Mock: Created contact with ID {contact_id}")
+        logger.debug(f"Mock: Created contact with ID {contact_id}")
         return contact_id
     
     def update_contact(self, contact_id: int, contact_data: Dict[str, Any]) -> bool:
@@ -102,16 +132,37 @@ class MockAmoCRMClient:
         
         # Update the contact
         contact = self.mock_contacts[contact_id]
+        self._unindex_contact(contact_id)
         contact['name'] = contact_data.get('name', contact['name'])
         contact['custom_fields_values'] = contact_data.get('custom_fields_values', contact['custom_fields_values'])
         contact['updated_at'] = int(time.time())
+        self._index_contact(contact)
         
-        logger.info(f"Mock: Updated contact {contact_id}")
+        logger.debug(f"Mock: Updated contact {contact_id}")
         return True
     
-    def create_or_update_contact(self, patient_data: Dict[str, Any]) -> Optional[int]:
-        """Mock: Create or update contact based on patient data."""
-        # Extract patient ID and phone from data
+    def create_deal(self, deal_data: Dict[str, Any], contact_id: Optional[int] = None) -> Optional[int]:
+        """Mock: Create new deal, linked to a contact if given."""
+        self._log_api_call('POST', 'leads', deal_data)
+        
+        deal_id = self.next_deal_id
+        self.next_deal_id += 1
+        
+        self.mock_deals[deal_id] = {
+            'id': deal_id,
+            'name': deal_data.get('name', 'Unknown'),
+            'pipeline_id': deal_data.get('pipeline_id'),
+            'status_id': deal_data.get('status_id'),
+            'custom_fields_values': deal_data.get('custom_fields_values', []),
+            'contact_id': contact_id,
+            'created_at': int(time.time())
+        }
+        
+        logger.debug(f"Mock: Created deal with ID {deal_id}")
+        return deal_id
+    
+    def _extract_contact_keys(self, patient_data: Dict[str, Any]) -> Tuple[Optional[str], Optional[str]]:
+        """Extract patient ID and phone from contact data."""
         patient_id = None
         phone = None
         
@@ -121,6 +172,20 @@ class MockAmoCRMClient:
             elif field['field_id'] == 2:  # Phone field
                 phone = field['values'][0]['value']
         
+        return patient_id, phone
+    
+    def _find_indexed_contact_id(self, patient_id: str, phone: Optional[str]) -> Optional[int]:
+        """Find an existing contact ID by patient ID, then phone, straight from the indexes."""
+        contact_ids = self._field_index.get((25, str(patient_id)))
+        if not contact_ids and phone:
+            contact_ids = self._phone_index.get(self._normalize_phone(phone))
+        return min(contact_ids) if contact_ids else None
+    
+    def create_or_update_contact(self, patient_data: Dict[str, Any]) -> Optional[int]:
+        """Mock: Create or update contact based on patient data."""
+        # Extract patient ID and phone from data
+        patient_id, phone = self._extract_contact_keys(patient_data)
+        
         if not patient_id:
             logger.error("Mock: Patient ID not found in data")
             return None
@@ -149,22 +214,39 @@ class MockAmoCRMClient:
         results = {
             'created': [],
             'updated': [],
-            'failed': []
+            'failed': [],
+            'ids': []  # Contact ID (or None on failure) per input, in input order
         }
         
         logger.info(f"Mock: Processing batch of {len(contacts_data)} contacts")
         
-        for contact_data in contacts_data:
-            try:
-                contact_id = self.create_or_update_contact(contact_data)
-                if contact_id:
-                    # Check if it was created or updated (simplified)
-                    results['created'].append(contact_id)
-                else:
+        with self._batch_lock:
+            for contact_data in contacts_data:
+                try:
+                    patient_id, phone = self._extract_contact_keys(contact_data)
+                    if not patient_id:
+                        logger.error("Mock: Patient ID not found in data")
+                        results['ids'].append(None)
+                        results['failed'].append(contact_data)
+                        continue
+                    
+                    # Existence is checked against the live indexes, so a repeated
+                    # patient later in the same batch resolves to the contact just created
+                    existing_id = self._find_indexed_contact_id(patient_id, phone)
+                    if existing_id is None:
+                        contact_id = self.create_contact(contact_data)
+                        results['created'].append(contact_id)
+                    elif self.update_contact(existing_id, contact_data):
+                        contact_id = existing_id
+                        results['updated'].append(contact_id)
+                    else:
+                        contact_id = None
+                        results['failed'].append(contact_data)
+                    results['ids'].append(contact_id)
+                except Exception as e:
+                    logger.error(f"Mock: Failed to process contact: {e}")
+                    results['ids'].append(None)
                     results['failed'].append(contact_data)
-            except Exception as e:
-                logger.error(f"Mock: Failed to process contact: {e}")
-                results['failed'].append(contact_data)
         
         logger.info(f"Mock: Batch results - Created: {len(results['created'])}, "
                    f"Updated: {len(results['updated'])}, Failed: {len(results['failed'])}")
@@ -206,7 +288,7 @@ class MockAmoCRMClient:
     
     def _normalize_phone(self, phone: str) -> str:
         """Normalize phone number for comparison."""
-        return ''.join(filter(str.isdigit, phone))
+        return normalize_phone(phone)
     
     def get_stats(self) -> Dict[str, Any]:
         """Get mock client statistics for testing."""
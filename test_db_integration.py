@@ -3,21 +3,82 @@
 
 import sys
 import os
+import atexit
 from datetime import datetime
+from functools import lru_cache
+
+import pytest
 from loguru import logger
 
+from logging_setup import configure_test_logging
+
 # Add src to path
-sys.path.append('src')
+if 'src' not in sys.path:
+    sys.path.append('src')
+
+from test_amocrm import MockAmoCRMClient
 
 # Configure logging
-logger.remove()
-logger.add(
-    sys.stdout,
-    level="DEBUG",
-    format="<green>{time:YYYY-MM-DD HH:mm:ss}</green> | <level>{level: <8}</level> | <cyan>{name}</cyan>:<cyan>{function}</cyan>:<cyan>{line}</cyan> - <level>{message}</level>"
-)
+configure_test_logging()
 
-def test_database_connection():
+# Test connection parameters
+CONNECTION_PARAMS = {
+    'server': 'localhost,1433',
+    'database': 'PZ',
+    'user': 'sa',
+    'password': 'TestPassword123!',
+    'driver': '{ODBC Driver 18 for SQL Server}',
+    'trust_server_certificate': 'yes'
+}
+
+
+# AmoCRM gender labels indexed by the Persons.Sex code
+GENDER_NAMES = ('Не указан', 'Мужской', 'Женский')
+
+# Patient fetched in full by the connection check; bound as a parameter so the
+# server reuses one cached plan
+SAMPLE_PATIENT_ID = 1
+
+
+@lru_cache(maxsize=1)
+def _get_conn():
+    """Open the test database connection once, trying pyodbc then pymssql."""
+    logger.info(f"Connecting to database: {CONNECTION_PARAMS['server']}")
+    
+    # Try pyodbc first
+    try:
+        import pyodbc
+        conn_str = (
+            f"DRIVER={CONNECTION_PARAMS['driver']};"
+            f"SERVER={CONNECTION_PARAMS['server']};"
+            f"DATABASE={CONNECTION_PARAMS['database']};"
+            f"UID={CONNECTION_PARAMS['user']};"
+            f"PWD={CONNECTION_PARAMS['password']};"
+            f"TrustServerCertificate=yes;"
+        )
+        
+        conn = pyodbc.connect(conn_str)
+        logger.info("✅ Connected using pyodbc")
+        
+    except Exception as e:
+        logger.warning(f"pyodbc failed: {e}")
+        
+        # Try pymssql
+        import pymssql
+        conn = pymssql.connect(
+            server=CONNECTION_PARAMS['server'],
+            user=CONNECTION_PARAMS['user'],
+            password=CONNECTION_PARAMS['password'],
+            database=CONNECTION_PARAMS['database']
+        )
+        logger.info("✅ Connected using pymssql")
+    
+    # Shared by every test, so closed once when the run ends
+    atexit.register(conn.close)
+    return conn
+
+
+def check_database_connection() -> bool:
     """Test connection to SQL Server in Docker."""
     logger.info("🧪 Testing Database Connection")
     
@@ -35,78 +96,32 @@ def test_database_connection():
                 logger.error("❌ No SQL Server drivers available")
                 return False
         
-        # Test connection parameters
-        connection_params = {
-            'server': 'localhost,1433',
-            'database': 'PZ',
-            'user': 'sa',
-            'password': 'TestPassword123!',
-            'driver': '{ODBC Driver 18 for SQL Server}',
-            'trust_server_certificate': 'yes'
-        }
-        
-        logger.info(f"Connecting to database: {connection_params['server']}")
-        
-        # Try pyodbc first
         try:
-            import pyodbc
-            conn_str = (
-                f"DRIVER={connection_params['driver']};"
-                f"SERVER={connection_params['server']};"
-                f"DATABASE={connection_params['database']};"
-                f"UID={connection_params['user']};"
-                f"PWD={connection_params['password']};"
-                f"TrustServerCertificate=yes;"
-            )
-            
-            conn = pyodbc.connect(conn_str)
+            conn = _get_conn()
             cursor = conn.cursor()
-            logger.info("✅ Connected using pyodbc")
-            
         except Exception as e:
-            logger.warning(f"pyodbc failed: {e}")
-            
-            # Try pymssql
-            try:
-                import pymssql
-                conn = pymssql.connect(
-                    server=connection_params['server'],
-                    user=connection_params['user'],
-                    password=connection_params['password'],
-                    database=connection_params['database']
-                )
-                cursor = conn.cursor()
-                logger.info("✅ Connected using pymssql")
-            except Exception as e2:
-                logger.error(f"❌ Both connection methods failed: {e2}")
-                return False
+            logger.error(f"❌ Both connection methods failed: {e}")
+            return False
         
         # Test basic queries
         logger.info("Testing basic queries...")
         
-        # Count patients
-        cursor.execute("SELECT COUNT(*) FROM Patients")
-        patient_count = cursor.fetchone()[0]
-        logger.info(f"✅ Found {patient_count} patients")
-        
-        # Get sample patient data
-        cursor.execute("""
+        # Count, sample and detail queries go out as one batch; each SELECT
+        # comes back as its own result set. pyodbc binds with ?, pymssql with %s
+        placeholder = '?' if type(conn).__module__.startswith('pyodbc') else '%s'
+        cursor.execute(f"""
+            SELECT COUNT(*) FROM Patients;
+            
+            -- Get sample patient data
             SELECT TOP 3
                 p.ID_Patients,
                 per.Surname,
                 per.Name,
                 per.MobilePhone
             FROM Patients p
-            LEFT JOIN Persons per ON p.ID_Persons = per.ID
-        """)
-        
-        rows = cursor.fetchall()
-        logger.info("✅ Sample patients:")
-        for row in rows:
-            logger.info(f"   - ID: {row[0]}, Name: {row[1]} {row[2]}, Phone: {row[3]}")
-        
-        # Test patient data retrieval for AmoCRM format
-        cursor.execute("""
+            LEFT JOIN Persons per ON p.ID_Persons = per.ID;
+            
+            -- Test patient data retrieval for AmoCRM format
             SELECT 
                 p.ID_Patients,
                 p.ID_Persons,
@@ -128,21 +143,33 @@ def test_database_connection():
                 per.Age
             FROM Patients p
             LEFT JOIN Persons per ON p.ID_Persons = per.ID
-            WHERE p.ID_Patients = 1
-        """)
+            WHERE p.ID_Patients = {placeholder};
+        """, (SAMPLE_PATIENT_ID,))
+        
+        # Count patients
+        patient_count = cursor.fetchone()[0]
+        logger.info(f"✅ Found {patient_count} patients")
         
+        cursor.nextset()
+        rows = cursor.fetchall()
+        # Lazy: the sample lines are only built if a sink accepts DEBUG
+        logger.info("✅ Sample patients:")
+        logger.opt(lazy=True).debug("{}", lambda: "\n".join(
+            f"   - ID: {row[0]}, Name: {row[1]} {row[2]}, Phone: {row[3]}" for row in rows
+        ))
+        
+        cursor.nextset()
         row = cursor.fetchone()
         if row:
-            logger.info("✅ Retrieved detailed patient data for ID 1:")
+            logger.info(f"✅ Retrieved detailed patient data for ID {SAMPLE_PATIENT_ID}:")
             logger.info(f"   - Name: {row[7]} {row[8]} {row[9]}")
             logger.info(f"   - Phone: {row[12]}")
             logger.info(f"   - Email: {row[13]}")
             logger.info(f"   - Age: {row[17]}")
             logger.info(f"   - Card: {row[3]}")
         else:
-            logger.warning("⚠️  No patient found with ID 1")
+            logger.warning(f"⚠️  No patient found with ID {SAMPLE_PATIENT_ID}")
         
-        conn.close()
         logger.info("🎉 Database connection test passed!")
         return True
         
@@ -151,46 +178,40 @@ def test_database_connection():
         return False
 
 
-def test_full_integration():
+def _to_contact(patient_row):
+    """Build AmoCRM contact data from a patient query row."""
+    full_name = f"{patient_row[1] or ''} {patient_row[2] or ''} {patient_row[3] or ''}".strip()
+    
+    return {
+        'name': full_name,
+        'custom_fields_values': [
+            {'field_id': 2, 'values': [{'value': patient_row[4] or ''}]},  # Phone
+            {'field_id': 25, 'values': [{'value': str(patient_row[0])}]},  # Patient ID
+            {'field_id': 3, 'values': [{'value': patient_row[6] or 0}]},  # Age
+            {'field_id': 4, 'values': [{'value': GENDER_NAMES[patient_row[7] if patient_row[7] in (1, 2) else 0]}]},  # Gender
+            {'field_id': 5, 'values': [{'value': patient_row[5] or ''}]},  # Email
+        ]
+    }
+
+
+def check_full_integration() -> bool:
     """Test full integration with database and mock AmoCRM."""
     logger.info("🧪 Testing Full Integration")
     
     try:
-        from test_amocrm import MockAmoCRMClient
-        
         # Initialize mock AmoCRM client
         amocrm = MockAmoCRMClient()
         logger.info("✅ Mock AmoCRM client initialized")
         
         # Test database connection and data retrieval
-        try:
-            import pyodbc
-            conn_str = (
-                "DRIVER={ODBC Driver 18 for SQL Server};"
-                "SERVER=localhost,1433;"
-                "DATABASE=PZ;"
-                "UID=sa;"
-                "PWD=TestPassword123!;"
-                "TrustServerCertificate=yes;"
-            )
-            conn = pyodbc.connect(conn_str)
-            cursor = conn.cursor()
-            
-        except Exception:
-            import pymssql
-            conn = pymssql.connect(
-                server='localhost,1433',
-                user='sa',
-                password='TestPassword123!',
-                database='PZ'
-            )
-            cursor = conn.cursor()
+        conn = _get_conn()
+        cursor = conn.cursor()
         
         logger.info("✅ Database connected")
         
         # Get patient data
         cursor.execute("""
-            SELECT 
+            SELECT TOP 3
                 p.ID_Patients,
                 per.Surname,
                 per.Name,
@@ -206,66 +227,33 @@ def test_full_integration():
             ORDER BY p.ID_Patients
         """)
         
-        patients = cursor.fetchall()
+        patients = cursor.fetchall()  # Test with first 3 patients
         logger.info(f"✅ Retrieved {len(patients)} patients from database")
         
-        # Convert and sync first few patients
-        synced_count = 0
-        for patient_row in patients[:3]:  # Test with first 3 patients
-            try:
-                # Create AmoCRM contact data
-                full_name = f"{patient_row[1] or ''} {patient_row[2] or ''} {patient_row[3] or ''}".strip()
-                
-                contact_data = {
-                    'name': full_name,
-                    'custom_fields_values': [
-                        {
-                            'field_id': 2,  # Phone
-                            'values': [{'value': patient_row[4] or ''}]
-                        },
-                        {
-                            'field_id': 25,  # Patient ID
-                            'values': [{'value': str(patient_row[0])}]
-                        },
-                        {
-                            'field_id': 3,  # Age
-                            'values': [{'value': patient_row[6] or 0}]
-                        },
-                        {
-                            'field_id': 4,  # Gender
-                            'values': [{'value': 'Мужской' if patient_row[7] == 1 else 'Женский' if patient_row[7] == 2 else 'Не указан'}]
-                        },
-                        {
-                            'field_id': 5,  # Email
-                            'values': [{'value': patient_row[5] or ''}]
-                        }
-                    ]
-                }
-                
-                # Sync to AmoCRM
-                contact_id = amocrm.create_or_update_contact(contact_data)
-                if contact_id:
-                    synced_count += 1
-                    logger.info(f"✅ Synced patient {patient_row[0]}: {full_name}")
-                else:
-                    logger.warning(f"⚠️  Failed to sync patient {patient_row[0]}")
-                    
-            except Exception as e:
-                logger.error(f"❌ Error syncing patient {patient_row[0]}: {e}")
+        # Convert first few patients and sync them in one batch call, the
+        # same path the sync service uses to upload contacts concurrently
+        contacts = [_to_contact(patient_row) for patient_row in patients]
+        results = amocrm.batch_create_or_update_contacts(contacts)
         
-        conn.close()
+        synced_count = 0
+        for patient_row, contact, contact_id in zip(patients, contacts, results['ids']):
+            if contact_id:
+                synced_count += 1
+                logger.debug("✅ Synced patient {}: {}", patient_row[0], contact['name'])
+            else:
+                logger.warning(f"⚠️  Failed to sync patient {patient_row[0]}")
         
         # Show sync results
         stats = amocrm.get_stats()
         logger.info("📊 Integration Test Results:")
-        logger.info(f"   - Patients processed: {len(patients[:3])}")
+        logger.info(f"   - Patients processed: {len(patients)}")
         logger.info(f"   - Successfully synced: {synced_count}")
         logger.info(f"   - Total contacts in AmoCRM: {stats['total_contacts']}")
         logger.info(f"   - API calls made: {stats['api_calls']}")
         
-        logger.info("✅ Created contacts:")
-        for contact in stats['contacts']:
-            logger.info(f"     * {contact['name']} (ID: {contact['id']})")
+        logger.info("✅ Created contacts:\n" + "\n".join(
+            f"     * {contact['name']} (ID: {contact['id']})" for contact in stats['contacts']
+        ))
         
         logger.info("🎉 Full integration test passed!")
         return True
@@ -275,13 +263,35 @@ def test_full_integration():
         return False
 
 
+# pytest entry points: skipped rather than failed when SQL Server isn't up
+
+def _require_database():
+    """Skip the calling test if the test database can't be reached."""
+    try:
+        _get_conn()
+    except Exception as e:
+        pytest.skip(f"SQL Server not reachable: {e}")
+
+
+def test_database_connection():
+    """Run the database connection check under pytest."""
+    _require_database()
+    assert check_database_connection()
+
+
+def test_full_integration():
+    """Run the full integration check under pytest."""
+    _require_database()
+    assert check_full_integration()
+
+
 def main():
     """Run database integration tests."""
     logger.info("🚀 Starting Database Integration Tests")
     
     tests = [
-        ("Database Connection", test_database_connection),
-        ("Full Integration", test_full_integration),
+        ("Database Connection", check_database_connection),
+        ("Full Integration", check_full_integration),
     ]
     
     passed = 0
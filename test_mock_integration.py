@@ -3,27 +3,148 @@
 
 import sys
 import os
+import time
+import threading
 from datetime import datetime
+from unittest.mock import patch
+
+import pytest
 from loguru import logger
 
+from logging_setup import configure_test_logging
+
 # Add src to path
-sys.path.append('src')
+if 'src' not in sys.path:
+    sys.path.append('src')
+
+from test_amocrm import MockAmoCRMClient
+from models import Patient, Person, Gender, PatientStatus
 
 # Configure logging
-logger.remove()
-logger.add(
-    sys.stdout,
-    level="DEBUG",
-    format="<green>{time:YYYY-MM-DD HH:mm:ss}</green> | <level>{level: <8}</level> | <cyan>{name}</cyan>:<cyan>{function}</cyan>:<cyan>{line}</cyan> - <level>{message}</level>"
-)
+configure_test_logging()
 
-def test_mock_amocrm():
+# Fixed timestamp for model fields that no check asserts on, so runs are repeatable
+FIXED_TIMESTAMP = datetime(2024, 1, 1, 12, 0, 0)
+
+# Full sync pipeline fixture: enough batches that a stop lands well before the
+# loader reaches the end, and a per-upload delay so batches pile up in flight
+PIPELINE_BATCH_SIZE = 5
+PIPELINE_BATCHES = 20
+UPLOAD_DELAY_SECONDS = 0.01
+
+
+class FakeIdentDatabase:
+    """In-memory IdentDatabase serving full sync batches and recording what is written."""
+    
+    def __init__(self, batches=(), error=None):
+        self.batches = list(batches)
+        self.error = error
+        self.synced = []
+        self.failures = []
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        return False
+    
+    def get_payload_hashes(self):
+        return {}
+    
+    def load_dimensions(self):
+        pass
+    
+    def iter_patient_batches(self, batch_size):
+        yield from self.batches
+        if self.error:
+            raise self.error
+    
+    def bulk_update_sync_state(self, rows):
+        self.synced.extend(rows)
+        return True
+    
+    def bulk_record_sync_failures(self, failures):
+        self.failures.extend(failures)
+
+
+class SlowMockAmoCRMClient(MockAmoCRMClient):
+    """Mock AmoCRM client whose batch uploads take a moment, so later batches pile up."""
+    
+    def __init__(self):
+        super().__init__()
+        self.on_upload = None
+    
+    def batch_create_or_update_contacts(self, contacts_data, batch_size=50):
+        if self.on_upload:
+            self.on_upload()
+        time.sleep(UPLOAD_DELAY_SECONDS)
+        return super().batch_create_or_update_contacts(contacts_data, batch_size)
+
+
+def make_patient(patient_id: int) -> Patient:
+    """Build a minimal patient with a phone of its own."""
+    person = Person(
+        id=patient_id,
+        surname="Пациент",
+        name=f"Тест{patient_id}",
+        mobile_phone=f"+7 (925) {patient_id:07d}",
+        date_time_changed=FIXED_TIMESTAMP
+    )
+    return Patient(id_patient=patient_id, id_persons=patient_id, person=person, last_updated=FIXED_TIMESTAMP)
+
+
+def make_patient_batches() -> list:
+    """Build PIPELINE_BATCHES batches of consecutive patient IDs."""
+    return [
+        [make_patient(start + offset) for offset in range(1, PIPELINE_BATCH_SIZE + 1)]
+        for start in range(0, PIPELINE_BATCHES * PIPELINE_BATCH_SIZE, PIPELINE_BATCH_SIZE)
+    ]
+
+
+def build_sync_manager(db: FakeIdentDatabase, amocrm: MockAmoCRMClient):
+    """Create a SyncManager around fakes, without connecting to IDENT or AmoCRM."""
+    # Imported here: src.sync pulls in pyodbc, which the other checks don't need
+    from src.sync import SyncManager
+    
+    manager = SyncManager.__new__(SyncManager)
+    manager.db = db
+    manager.amocrm = amocrm
+    manager.batch_size = PIPELINE_BATCH_SIZE
+    manager.upload_concurrency = 2
+    manager._stop_event = threading.Event()
+    manager._payload_hashes = {}
+    return manager
+
+
+def track_upload_window(manager) -> dict:
+    """Record the most batches the full sync has prepared but not yet recorded."""
+    window = {'open': 0, 'max': 0}
+    prepare_batch, finish_upload = manager._prepare_patient_batch, manager._finish_upload
+    
+    # Both run on the sync thread, so the counters need no lock
+    def prepare(patients):
+        window['open'] += 1
+        window['max'] = max(window['max'], window['open'])
+        return prepare_batch(patients)
+    
+    def finish(*args):
+        window['open'] -= 1
+        return finish_upload(*args)
+    
+    manager._prepare_patient_batch = prepare
+    manager._finish_upload = finish
+    return window
+
+
+def loader_running() -> bool:
+    """Check whether a full sync loader thread is still alive."""
+    return any(thread.name == "patient-loader" for thread in threading.enumerate())
+
+def check_mock_amocrm() -> bool:
     """Test the mock AmoCRM client."""
     logger.info("🧪 Testing Mock AmoCRM Client")
     
     try:
-        from test_amocrm import MockAmoCRMClient
-        
         # Initialize mock client
         client = MockAmoCRMClient()
         logger.info("✅ Mock AmoCRM client initialized")
@@ -51,8 +172,34 @@ def test_mock_amocrm():
             ]
         }
         
-        # Create contact
-        contact_id = client.create_contact(test_contact_data)
+        # Test batch operations: all contacts are created in one call
+        batch_data = [
+            test_contact_data,
+            {
+                'name': 'Петрова Мария Сергеевна',
+                'custom_fields_values': [
+                    {'field_id': 2, 'values': [{'value': '+7 (916) 987-65-43'}]},
+                    {'field_id': 25, 'values': [{'value': '2'}]}
+                ]
+            },
+            {
+                'name': 'Сидоров Петр Александрович',
+                'custom_fields_values': [
+                    {'field_id': 2, 'values': [{'value': '+7 (903) 555-44-33'}]},
+                    {'field_id': 25, 'values': [{'value': '3'}]}
+                ]
+            }
+        ]
+        
+        batch_results = client.batch_create_or_update_contacts(batch_data)
+        logger.info(f"✅ Batch operation results: {len(batch_results['created'])} created, {len(batch_results['failed'])} failed")
+        
+        # Contact IDs must line up with the submitted contacts
+        if len(batch_results['ids']) != len(batch_data) or None in batch_results['ids']:
+            logger.error("❌ Batch contact IDs are not aligned with input")
+            return False
+        
+        contact_id = batch_results['ids'][0]
         logger.info(f"✅ Created contact with ID: {contact_id}")
         
         # Test finding contact by phone
@@ -89,36 +236,14 @@ def test_mock_amocrm():
             logger.error("❌ Failed to update contact")
             return False
         
-        # Test batch operations
-        batch_data = [
-            {
-                'name': 'Петрова Мария Сергеевна',
-                'custom_fields_values': [
-                    {'field_id': 2, 'values': [{'value': '+7 (916) 987-65-43'}]},
-                    {'field_id': 25, 'values': [{'value': '2'}]}
-                ]
-            },
-            {
-                'name': 'Сидоров Петр Александрович',
-                'custom_fields_values': [
-                    {'field_id': 2, 'values': [{'value': '+7 (903) 555-44-33'}]},
-                    {'field_id': 25, 'values': [{'value': '3'}]}
-                ]
-            }
-        ]
-        
-        batch_results = client.batch_create_or_update_contacts(batch_data)
-        logger.info(f"✅ Batch operation results: {len(batch_results['created'])} created, {len(batch_results['failed'])} failed")
-        
         # Show statistics
         stats = client.get_stats()
         logger.info("📊 Mock AmoCRM Statistics:")
         logger.info(f"   - Total contacts: {stats['total_contacts']}")
         logger.info(f"   - API calls made: {stats['api_calls']}")
-        logger.info(f"   - Created contacts:")
-        
-        for contact in stats['contacts']:
-            logger.info(f"     * {contact['name']} (ID: {contact['id']})")
+        logger.info("   - Created contacts:\n" + "\n".join(
+            f"     * {contact['name']} (ID: {contact['id']})" for contact in stats['contacts']
+        ))
         
         logger.info("🎉 All mock tests passed!")
         return True
@@ -128,13 +253,11 @@ def test_mock_amocrm():
         return False
 
 
-def test_patient_model():
+def check_patient_model() -> bool:
     """Test patient model and AmoCRM format conversion."""
     logger.info("🧪 Testing Patient Model")
     
     try:
-        from models import Patient, Person, Gender, PatientStatus
-        
         # Create test person
         person = Person(
             id=1,
@@ -151,7 +274,7 @@ def test_patient_model():
             snils="12345678901",
             passport="1234 567890",
             age=39,
-            date_time_changed=datetime.now()
+            date_time_changed=FIXED_TIMESTAMP
         )
         
         # Create test patient
@@ -166,7 +289,7 @@ def test_patient_model():
             archive_reason=None,
             branch="Главный филиал",
             person=person,
-            last_updated=datetime.now(),
+            last_updated=FIXED_TIMESTAMP,
             discount=5.0,
             total_visits=2,
             advance=0.0,
@@ -192,7 +315,8 @@ def test_patient_model():
             }.get(field['field_id'], f"Field {field['field_id']}")
             
             value = field['values'][0]['value'] if field['values'] else 'N/A'
-            logger.info(f"     * {field_name}: {value}")
+            # Deferred formatting: the line is only built if a sink accepts INFO
+            logger.info("     * {}: {}", field_name, value)
         
         logger.info("🎉 Patient model test passed!")
         return True
@@ -202,13 +326,147 @@ def test_patient_model():
         return False
 
 
+def check_full_sync_pipeline() -> bool:
+    """Test that the threaded full sync records every patient exactly once."""
+    logger.info("🧪 Testing Full Sync Pipeline")
+    
+    try:
+        batches = make_patient_batches()
+        loader = FakeIdentDatabase(batches)
+        writer = FakeIdentDatabase()
+        amocrm = SlowMockAmoCRMClient()
+        manager = build_sync_manager(loader, amocrm)
+        window = track_upload_window(manager)
+        
+        with patch('src.sync.IdentDatabase', return_value=writer):
+            manager._full_patient_sync()
+        
+        # Results land on the writer connection, never the loader's
+        expected = [patient.id_patient for batch in batches for patient in batch]
+        recorded = [row[0] for row in writer.synced]
+        if sorted(recorded) != expected or loader.synced:
+            logger.error(f"❌ Expected {len(expected)} patients recorded once, got {len(recorded)}")
+            return False
+        if writer.failures:
+            logger.error(f"❌ Unexpected sync failures: {writer.failures}")
+            return False
+        logger.info(f"✅ Recorded {len(recorded)} patients exactly once")
+        
+        # The in-flight window stops the sync thread from running ahead of uploads
+        if window['max'] > manager.upload_concurrency:
+            logger.error(f"❌ {window['max']} batches in flight, window is {manager.upload_concurrency}")
+            return False
+        logger.info(f"✅ At most {window['max']} batches in flight")
+        
+        if loader_running():
+            logger.error("❌ Loader thread still running")
+            return False
+        
+        logger.info("🎉 Full sync pipeline test passed!")
+        return True
+        
+    except Exception as e:
+        logger.error(f"❌ Full sync pipeline test failed: {e}")
+        return False
+
+
+def check_full_sync_interrupted() -> bool:
+    """Test that a loader error or stop() ends the full sync cleanly."""
+    logger.info("🧪 Testing Interrupted Full Sync")
+    
+    try:
+        batches = make_patient_batches()
+        
+        # A failing loader surfaces its error after the batches it already read
+        loader = FakeIdentDatabase(batches[:1], error=RuntimeError("connection lost"))
+        writer = FakeIdentDatabase()
+        manager = build_sync_manager(loader, SlowMockAmoCRMClient())
+        
+        with patch('src.sync.IdentDatabase', return_value=writer):
+            try:
+                manager._full_patient_sync()
+                logger.error("❌ Loader error was swallowed")
+                return False
+            except RuntimeError as e:
+                logger.info(f"✅ Loader error propagated: {e}")
+        
+        if loader_running():
+            logger.error("❌ Loader thread still running after its error")
+            return False
+        
+        # stop() during the first upload drains what was already queued and returns
+        loader = FakeIdentDatabase(batches)
+        writer = FakeIdentDatabase()
+        amocrm = SlowMockAmoCRMClient()
+        manager = build_sync_manager(loader, amocrm)
+        amocrm.on_upload = manager.stop
+        
+        with patch('src.sync.IdentDatabase', return_value=writer):
+            manager._full_patient_sync()
+        
+        recorded = [row[0] for row in writer.synced]
+        uploaded = amocrm.get_stats()['total_contacts']
+        if len(set(recorded)) != len(recorded) or len(recorded) != uploaded:
+            logger.error(f"❌ {uploaded} contacts uploaded but {len(recorded)} recorded")
+            return False
+        if uploaded >= len(batches) * PIPELINE_BATCH_SIZE:
+            logger.error("❌ stop() did not end the full sync early")
+            return False
+        if loader_running():
+            logger.error("❌ Loader thread still running after stop()")
+            return False
+        logger.info(f"✅ Stopped after {uploaded} patients, each recorded once")
+        
+        logger.info("🎉 Interrupted full sync test passed!")
+        return True
+        
+    except Exception as e:
+        logger.error(f"❌ Interrupted full sync test failed: {e}")
+        return False
+
+
+# pytest entry points: each check builds its own client and data, so they can
+# run in any order or in separate workers
+
+def _require_sync_module():
+    """Skip the calling test if src.sync can't be imported, e.g. without an ODBC driver."""
+    try:
+        import src.sync  # noqa: F401
+    except ImportError as e:
+        pytest.skip(f"src.sync not importable: {e}")
+
+
+def test_mock_amocrm():
+    """Run the mock AmoCRM client check under pytest."""
+    assert check_mock_amocrm()
+
+
+def test_patient_model():
+    """Run the patient model check under pytest."""
+    assert check_patient_model()
+
+
+def test_full_sync_pipeline():
+    """Run the full sync pipeline check under pytest."""
+    _require_sync_module()
+    assert check_full_sync_pipeline()
+
+
+def test_full_sync_interrupted():
+    """Run the interrupted full sync check under pytest."""
+    _require_sync_module()
+    assert check_full_sync_interrupted()
+
+
 def main():
     """Run all tests."""
     logger.info("🚀 Starting Mock Integration Tests")
     
     tests = [
-        ("Mock AmoCRM Client", test_mock_amocrm),
-        ("Patient Model", test_patient_model),
+        ("Mock AmoCRM Client", check_mock_amocrm),
+        ("Patient Model", check_patient_model),
+        ("Full Sync Pipeline", check_full_sync_pipeline),
+        ("Interrupted Full Sync", check_full_sync_interrupted),
     ]
     
     passed = 0
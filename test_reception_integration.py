@@ -3,8 +3,9 @@
 import os
 import sys
 import unittest
+from functools import lru_cache
 from datetime import datetime, timedelta
-from unittest.mock import Mock, patch
+from unittest.mock import MagicMock, Mock, patch
 
 # Add src to path
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'src'))
@@ -15,26 +16,47 @@ from src.database import IdentDatabase
 from config import AMOCRM_CONFIG, FIELD_MAPPING
 
 
-class TestReceptionSync(unittest.TestCase):
+@lru_cache(maxsize=1)
+def _cached_receptions():
+    """Fetch receptions from the database once for all integration tests."""
+    with IdentDatabase() as db:
+        return tuple(db.get_receptions())
+
+
+class ReceptionSyncTestCase(unittest.TestCase):
+    """Base class for tests that drive a ReceptionSyncManager with a mock AmoCRM client."""
+    
+    def _mock_amocrm(self, **methods):
+        """Replace AmoCRM client methods with mocks for the current test only."""
+        for name, return_value in methods.items():
+            patcher = patch.object(self.reception_sync.amocrm, name, Mock(return_value=return_value), create=True)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+
+class TestReceptionSync(ReceptionSyncTestCase):
     """Test reception synchronization logic."""
     
-    def setUp(self):
-        """Set up test environment."""
-        self.reception_sync = ReceptionSyncManager(use_mock=True)
+    @classmethod
+    def setUpClass(cls):
+        """Set up the shared, read-mostly test fixtures once for the class."""
+        cls.reception_sync = ReceptionSyncManager(use_mock=True)
         
         # Create test reception
-        self.test_reception = Reception(
+        cls.test_reception = Reception(
             id_reception=12345,
             id_patient=100,
-            reception_datetime=datetime.now(),
+            patient_number="PAT001",
+            phone="+79161234567",
+            appointment_date=datetime.now(),
             status=ReceptionStatus.SCHEDULED,
-            doctor_name="Dr. Smith",
-            service_name="Consultation",
-            cost=1500.0
+            staff_name="Dr. Smith",
+            duration=30,
+            comment="Consultation"
         )
         
         # Create test patient with person
-        self.test_person = Person(
+        cls.test_person = Person(
             id=1,
             surname="Иванов",
             name="Иван",
@@ -46,17 +68,32 @@ class TestReceptionSync(unittest.TestCase):
             email="ivan@example.com"
         )
         
-        self.test_patient = Patient(
+        cls.test_patient = Patient(
             id_patient=100,
             id_persons=1,
             first_visit=datetime.now().date(),
             card_number="CARD001",
             patient_number="PAT001",
             status=PatientStatus.ACTIVE,
-            person=self.test_person,
+            person=cls.test_person,
             completed_receptions_count=0  # Primary patient
         )
     
+    def setUp(self):
+        """Reset per-test state on the shared fixtures."""
+        self.reception_sync._clear_search_cache()
+        
+        count = self.test_patient.completed_receptions_count
+        self.addCleanup(setattr, self.test_patient, 'completed_receptions_count', count)
+        
+        # The manager built its IdentDatabase in setUpClass, so swap that
+        # instance for a mock; no test opens a real connection
+        self.mock_db = MagicMock()
+        self.mock_db.__enter__.return_value = self.mock_db
+        patcher = patch.object(self.reception_sync, 'db', self.mock_db)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+    
     def test_funnel_determination(self):
         """Test funnel type determination based on completed receptions."""
         # Primary patient (0 completed receptions)
@@ -87,23 +124,21 @@ class TestReceptionSync(unittest.TestCase):
         self.assertIn("name", deal_data)
         self.assertIn("custom_fields_values", deal_data)
         
-        # Check custom fields
-        custom_fields = {field["field_id"]: field["values"][0]["value"] 
-                        for field in deal_data["custom_fields_values"]}
+        # Check custom fields, stopping at the reception ID field
+        target = FIELD_MAPPING["reception_id"]
+        reception_id = next(field["values"][0]["value"] for field in deal_data["custom_fields_values"]
+                            if field["field_id"] == target)
         
-        self.assertEqual(custom_fields[FIELD_MAPPING["reception_id"]], 12345)
+        self.assertEqual(reception_id, 12345)
     
-    @patch('src.reception_sync.IdentDatabase')
-    def test_find_existing_deal_hierarchy(self, mock_db_class):
+    def test_find_existing_deal_hierarchy(self):
         """Test the search hierarchy for finding existing deals."""
-        # Mock database
-        mock_db = Mock()
-        mock_db_class.return_value.__enter__.return_value = mock_db
-        
         # Mock AmoCRM client methods
-        self.reception_sync.amocrm.find_deal_by_reception_id = Mock(return_value=None)
-        self.reception_sync.amocrm.find_deal_by_patient_number = Mock(return_value=None)
-        self.reception_sync.amocrm.find_contact_by_phone = Mock(return_value=None)
+        self._mock_amocrm(
+            find_deal_by_reception_id=None,
+            find_deal_by_patient_number=None,
+            find_contact_by_phone=None
+        )
         
         result = self.reception_sync._find_existing_deal_or_contact(self.test_reception)
         
@@ -123,16 +158,10 @@ class TestReceptionSync(unittest.TestCase):
         secondary_id = self.reception_sync._get_pipeline_id(FunnelType.SECONDARY)
         self.assertEqual(secondary_id, AMOCRM_CONFIG["secondary_pipeline_id"])
     
-    @patch('src.reception_sync.IdentDatabase')
-    def test_create_new_deal_flow(self, mock_db_class):
+    def test_create_new_deal_flow(self):
         """Test creation of new contact and deal."""
-        # Mock database
-        mock_db = Mock()
-        mock_db_class.return_value.__enter__.return_value = mock_db
-        
         # Mock successful contact and deal creation
-        self.reception_sync.amocrm.create_contact = Mock(return_value=123)
-        self.reception_sync.amocrm.create_deal = Mock(return_value=456)
+        self._mock_amocrm(create_contact=123, create_deal=456)
         
         pipeline_id = AMOCRM_CONFIG["primary_pipeline_id"]
         
@@ -173,27 +202,92 @@ class TestReceptionSync(unittest.TestCase):
         self.assertIsInstance(deal_id, int)
 
 
-class TestReceptionSyncIntegration(unittest.TestCase):
-    """Integration tests for reception synchronization."""
+class TestReceptionSearchCache(ReceptionSyncTestCase):
+    """Test per-run caching of AmoCRM search lookups."""
     
     def setUp(self):
         """Set up test environment."""
         self.reception_sync = ReceptionSyncManager(use_mock=True)
+        self._mock_amocrm(
+            find_deal_by_reception_id=None,
+            find_deal_by_patient_number=None,
+            find_contact_by_phone=None
+        )
+        
+        self.reception = Reception(
+            id_reception=12345,
+            id_patient=100,
+            patient_number="PAT001",
+            phone="+79161234567"
+        )
+    
+    def test_repeated_lookup_hits_cache(self):
+        """Test that the same search keys reach AmoCRM only once per run."""
+        self.reception_sync._find_existing_deal_or_contact(self.reception)
+        self.reception_sync._find_existing_deal_or_contact(self.reception)
+        
+        self.reception_sync.amocrm.find_deal_by_reception_id.assert_called_once_with(12345)
+        self.reception_sync.amocrm.find_deal_by_patient_number.assert_called_once_with("PAT001")
+        self.reception_sync.amocrm.find_contact_by_phone.assert_called_once_with("+79161234567")
+    
+    def test_invalidate_after_write(self):
+        """Test that invalidation drops cached lookups for the reception."""
+        self.reception_sync._find_existing_deal_or_contact(self.reception)
+        self.reception_sync._invalidate_search_cache(self.reception)
+        self.reception_sync._find_existing_deal_or_contact(self.reception)
+        
+        self.assertEqual(self.reception_sync.amocrm.find_contact_by_phone.call_count, 2)
+    
+    def test_invalidate_after_failed_write(self):
+        """Test that a contact created before a failed deal is not hidden by the cache."""
+        self._mock_amocrm(create_contact=123, create_deal=None)
+        self.reception_sync.amocrm.create_deal.side_effect = RuntimeError("deal rejected")
+        patient = Patient(id_patient=100, id_persons=1, patient_number="PAT001")
+        
+        with patch.object(self.reception_sync, '_get_patient_data', Mock(return_value=patient)):
+            result = self.reception_sync._sync_single_reception(self.reception, Mock())
+        
+        self.assertFalse(result.success)
+        self.assertNotIn(self.reception.phone, self.reception_sync._contact_by_phone_cache)
+    
+    def test_second_reception_reuses_written_contact(self):
+        """Test that a patient's second reception finds the first one's contact without searching."""
+        self._mock_amocrm(create_contact=123, create_deal=456, update_contact=True, update_deal=True)
+        patient = Patient(id_patient=100, id_persons=1, patient_number="PAT001")
+        second = Reception(id_reception=12346, id_patient=100, patient_number="PAT001", phone="+79161234567")
+        
+        with patch.object(self.reception_sync, '_get_patient_data', Mock(return_value=patient)):
+            first_result = self.reception_sync._sync_single_reception(self.reception, Mock())
+            second_result = self.reception_sync._sync_single_reception(second, Mock())
+        
+        self.assertEqual(first_result.action, "created")
+        self.assertEqual(second_result.amocrm_contact_id, 123)
+        self.reception_sync.amocrm.find_deal_by_patient_number.assert_called_once_with("PAT001")
+        self.reception_sync.amocrm.find_contact_by_phone.assert_called_once_with("+79161234567")
+        self.reception_sync.amocrm.create_contact.assert_called_once()
+
+
+class TestReceptionSyncIntegration(unittest.TestCase):
+    """Integration tests for reception synchronization."""
+    
+    @classmethod
+    def setUpClass(cls):
+        """Set up test environment."""
+        cls.reception_sync = ReceptionSyncManager(use_mock=True)
     
     def test_database_connection(self):
         """Test database connectivity for reception sync."""
         try:
-            with IdentDatabase() as db:
-                # Test getting receptions
-                receptions = db.get_receptions()
-                self.assertIsInstance(receptions, list)
-                
-                print(f"Found {len(receptions)} receptions in database")
-                
-                # Test getting patients
-                if receptions:
-                    sample_reception = receptions[0]
-                    print(f"Sample reception: ID {sample_reception.id_reception}, Patient {sample_reception.id_patient}")
+            # Test getting receptions
+            receptions = _cached_receptions()
+            self.assertIsInstance(receptions, tuple)
+            
+            print(f"Found {len(receptions)} receptions in database")
+            
+            # Test getting patients
+            if receptions:
+                sample_reception = receptions[0]
+                print(f"Sample reception: ID {sample_reception.id_reception}, Patient {sample_reception.id_patient}")
                     
         except Exception as e:
             self.fail(f"Database connection failed: {e}")
@@ -228,9 +322,8 @@ class TestReceptionSyncIntegration(unittest.TestCase):
         """Test syncing a single reception."""
         try:
             # Get a reception ID from database
-            with IdentDatabase() as db:
-                receptions = db.get_receptions()
-                
+            receptions = _cached_receptions()
+            
             if not receptions:
                 self.skipTest("No receptions found in database")
             